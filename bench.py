@@ -0,0 +1,235 @@
+"""MemeGen离线基准测试
+
+不需要真实微信账号：用本地的 FakeWechatAPIClient 代替 WechatAPIClient，
+头像由本地HTTP服务提供，生成的表情发送到内存中的接收器。
+
+在机器人根目录下运行：
+    python -m plugins.MemeGen.bench --messages 500 --concurrency 16 --latency 50
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import resource
+import socket
+import tempfile
+import time
+
+from aiohttp import web
+from PIL import Image
+
+
+class FakeWechatAPIClient:
+    """模拟WechatAPIClient，各接口带可配置的延迟"""
+
+    def __init__(self, avatar_base_url, latency=0.05, chatroom_latency=0.2, profile_latency=0.1,
+                 contact_miss_ratio=0.0):
+        self.avatar_base_url = avatar_base_url
+        self.latency = latency
+        self.chatroom_latency = chatroom_latency
+        self.profile_latency = profile_latency
+        # 按比例让get_contact拿不到头像，以覆盖群成员列表回退路径
+        self.contact_miss_ratio = contact_miss_ratio
+        self.calls = {"get_contact": 0, "get_chatroom_member_list": 0, "get_profile": 0}
+        self.sent_images = []
+        self.sent_texts = []
+        self.members = {}
+
+    def _avatar_url(self, wxid):
+        return f"{self.avatar_base_url}/avatar/{wxid}.jpg"
+
+    async def get_contact(self, wxid):
+        self.calls["get_contact"] += 1
+        await asyncio.sleep(self.latency)
+        if random.random() < self.contact_miss_ratio:
+            return {"UserName": wxid}
+        return {"UserName": wxid, "BigHeadImgUrl": self._avatar_url(wxid)}
+
+    async def get_chatroom_member_list(self, chatroom):
+        self.calls["get_chatroom_member_list"] += 1
+        await asyncio.sleep(self.chatroom_latency)
+        return [
+            {"UserName": wxid, "BigHeadImgUrl": self._avatar_url(wxid)}
+            for wxid in self.members.get(chatroom, [])
+        ]
+
+    async def get_profile(self, wxid):
+        self.calls["get_profile"] += 1
+        await asyncio.sleep(self.profile_latency)
+        return {"smallHeadImgUrl": self._avatar_url(wxid)}
+
+    async def send_image_message(self, wxid, image):
+        self.sent_images.append((wxid, len(image)))
+        return random.randint(1, 1 << 30), int(time.time()), random.randint(1, 1 << 62)
+
+    async def send_text_message(self, wxid, content, at=None):
+        self.sent_texts.append((wxid, content))
+        return random.randint(1, 1 << 30), int(time.time()), random.randint(1, 1 << 62)
+
+
+def make_avatar(wxid, size=640):
+    """为每个wxid生成固定颜色的JPEG头像"""
+    rng = random.Random(wxid)
+    color = tuple(rng.randrange(256) for _ in range(3))
+    image = Image.new("RGB", (size, size), color)
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+
+async def start_avatar_server():
+    """启动本地头像HTTP服务，返回(runner, 基础URL)"""
+    avatars = {}
+
+    async def handle(request):
+        wxid = request.match_info["wxid"]
+        if wxid not in avatars:
+            avatars[wxid] = make_avatar(wxid)
+        return web.Response(body=avatars[wxid], content_type="image/jpeg")
+
+    app = web.Application()
+    app.router.add_get("/avatar/{wxid}.jpg", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    await web.SockSite(runner, sock).start()
+    return runner, f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+def make_message(chatroom, trigger, at_users):
+    """构造一条@用户+触发词的群消息"""
+    mentions = "".join(f"@{wxid}\u2005" for wxid in at_users)
+    return {
+        "Content": f"{mentions}{trigger}",
+        "FromWxid": chatroom,
+        "IsGroup": True,
+        "ActualUserWxid": "wxid_bench_sender",
+        "AtUserList": list(at_users),
+    }
+
+
+def peak_memory_mb():
+    """返回本进程和已结束子进程的内存峰值（MB）"""
+    self_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return self_peak, children_peak
+
+
+async def run_templates(plugin, bot, chatroom, users, templates):
+    """每个模板各生成一次，统计单模板耗时和输出大小"""
+    results = []
+    for trigger, emoji_type, persons in templates:
+        before = len(bot.sent_images)
+        start = time.perf_counter()
+        await plugin.handle_text(bot, make_message(chatroom, trigger, users[:persons]))
+        elapsed = time.perf_counter() - start
+        size = bot.sent_images[-1][1] if len(bot.sent_images) > before else 0
+        results.append((emoji_type, trigger, elapsed, size, len(bot.sent_images) > before))
+    return results
+
+
+async def run_throughput(plugin, bot, chatroom, users, templates, messages, concurrency):
+    """并发发送随机表情请求，返回每秒处理的消息数"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        trigger, _, persons = random.choice(templates)
+        async with semaphore:
+            await plugin.handle_text(bot, make_message(chatroom, trigger, random.sample(users, persons)))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(messages)))
+    return messages / (time.perf_counter() - start)
+
+
+async def main(options):
+    random.seed(options.seed)
+    os.environ["MEMEGEN_TEMP_DIR"] = options.temp_dir or tempfile.mkdtemp(prefix="memegen-bench-")
+    from .main import MemeGen
+
+    runner, base_url = await start_avatar_server()
+    bot = FakeWechatAPIClient(
+        base_url,
+        latency=options.latency / 1000,
+        chatroom_latency=options.chatroom_latency / 1000,
+        profile_latency=options.profile_latency / 1000,
+        contact_miss_ratio=options.contact_miss_ratio,
+    )
+    chatroom = "bench@chatroom"
+    users = [f"wxid_bench_{i}" for i in range(options.users)]
+    bot.members[chatroom] = users
+
+    plugin = MemeGen()
+    # 所有消息来自同一个群和同一个用户，按配置限流时测到的只是拒绝路径
+    if not options.keep_limits:
+        plugin.scheduler.allow = lambda group_id, user_id: True
+    plugin.send_interval = options.send_interval
+    plugin.use_filehelper_cache = options.filehelper
+    await plugin.async_init()
+
+    with open(os.path.join(os.path.dirname(__file__), "emoji.json"), "r", encoding="utf-8") as f:
+        emoji_config = json.load(f)
+    templates = [(trigger, emoji_type, 1) for trigger, emoji_type in emoji_config.get("one_PicEwo", {}).items()]
+    templates += [(trigger, emoji_type, 2) for trigger, emoji_type in emoji_config.get("two_PicEwo", {}).items()]
+    if options.templates:
+        wanted = set(options.templates.split(","))
+        templates = [t for t in templates if t[1] in wanted or t[0] in wanted]
+
+    print(f"临时目录: {os.environ['MEMEGEN_TEMP_DIR']}")
+    print(f"模板数: {len(templates)}，用户数: {len(users)}，渲染进程: {plugin.render_workers}")
+    print(f"限流: {'开启' if options.keep_limits else '关闭'}，发送间隔: {plugin.send_interval} 秒，"
+          f"文件助手缓存: {'开启' if plugin.use_filehelper_cache else '关闭'}")
+
+    try:
+        if not options.skip_templates:
+            print("\n== 单模板渲染（冷缓存） ==")
+            failed = []
+            for emoji_type, trigger, elapsed, size, ok in await run_templates(plugin, bot, chatroom, users, templates):
+                if not ok:
+                    failed.append(emoji_type)
+                print(f"{emoji_type:<24}{trigger:<12}{elapsed * 1000:>9.1f} ms{size / 1024:>10.1f} KB{'' if ok else '  失败'}")
+            if failed:
+                print(f"失败模板: {', '.join(failed)}")
+
+        print(f"\n== 吞吐量（{options.messages}条消息，并发{options.concurrency}） ==")
+        rate = await run_throughput(plugin, bot, chatroom, users, templates, options.messages, options.concurrency)
+        print(f"吞吐量: {rate:.1f} 条/秒")
+
+        # 渲染进程退出后才能统计到它们的内存峰值
+        plugin.renderer.shutdown(wait=True)
+        self_peak, children_peak = peak_memory_mb()
+        print(f"内存峰值: 主进程 {self_peak:.1f} MB，渲染进程 {children_peak:.1f} MB")
+        print(f"接口调用次数: {bot.calls}")
+        print(f"发送图片: {len(bot.sent_images)}，发送文本: {len(bot.sent_texts)}")
+
+        print("\n== 插件指标 ==")
+        print(plugin.metrics.summary())
+    finally:
+        await plugin.on_disable()
+        await runner.cleanup()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="MemeGen离线基准测试")
+    parser.add_argument("--messages", type=int, default=200, help="吞吐量测试的消息数")
+    parser.add_argument("--concurrency", type=int, default=16, help="同时处理的消息数")
+    parser.add_argument("--users", type=int, default=20, help="参与测试的群成员数")
+    parser.add_argument("--latency", type=float, default=50, help="get_contact延迟（毫秒）")
+    parser.add_argument("--chatroom-latency", type=float, default=200, help="get_chatroom_member_list延迟（毫秒）")
+    parser.add_argument("--profile-latency", type=float, default=100, help="get_profile延迟（毫秒）")
+    parser.add_argument("--contact-miss-ratio", type=float, default=0.1, help="get_contact拿不到头像的比例")
+    parser.add_argument("--templates", default="", help="只测试指定的表情类型或触发词，逗号分隔")
+    parser.add_argument("--skip-templates", action="store_true", help="跳过逐模板渲染测试")
+    parser.add_argument("--temp-dir", default="", help="缓存目录，默认使用新的临时目录")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--keep-limits", action="store_true", help="保留[schedule]中按群和按用户的限流")
+    parser.add_argument("--send-interval", type=float, default=0, help="发送间隔（秒），默认不节流")
+    parser.add_argument("--filehelper", action="store_true", help="开启文件助手缓存（模拟客户端不会回显，只会多一次上传）")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,53 @@
+"""MemeGen熔断器 - 接口连续失败时暂停调用，避免故障期间请求堆积"""
+import time
+
+
+class CircuitBreaker:
+    """单个接口的熔断器
+
+    连续失败 failure_threshold 次后打开，cooldown 秒内直接跳过该接口；
+    冷却结束后进入半开状态，只放行一次试探调用，成功则关闭，失败则重新打开；
+    试探调用一个冷却期内没有结果（如被取消）时再放行下一次试探。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, cooldown=30):
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = 0.0
+        self._state = self.CLOSED
+        self._probing = False
+
+    @property
+    def state(self):
+        if self._state != self.CLOSED and time.monotonic() - self.opened_at >= self.cooldown:
+            self._state = self.HALF_OPEN
+            self._probing = False
+        return self._state
+
+    def allow(self):
+        """返回本次是否允许调用接口"""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self._state = self.CLOSED
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self._state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._probing = False
@@ -0,0 +1,474 @@
+"""MemeGen缓存组件"""
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+
+from loguru import logger
+
+try:
+    import fcntl
+except ImportError:  # Windows没有fcntl，无法跨进程共享缓存
+    fcntl = None
+
+
+def atomic_write(path, data):
+    """先写入同目录下的临时文件再重命名，读者不会看到写了一半的文件"""
+    directory, filename = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f"{filename}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class FileLock:
+    """基于flock的跨进程锁，供共享同一缓存目录的多个机器人实例协调
+
+    键经哈希后映射到固定数量的锁文件，锁文件数有上限且从不删除；
+    不同的键偶尔落到同一个锁文件只会多等一会儿，不影响正确性。
+    """
+
+    BUCKETS = 4096
+    available = fcntl is not None
+
+    def __init__(self, lock_dir):
+        self.lock_dir = lock_dir
+        os.makedirs(lock_dir, exist_ok=True)
+
+    def _path(self, key):
+        bucket = int(hashlib.sha1(key.encode("utf-8")).hexdigest(), 16) % self.BUCKETS
+        return os.path.join(self.lock_dir, f"{bucket:03x}.lock")
+
+    @contextmanager
+    def hold(self, key):
+        """阻塞等待并持有锁（同步代码中使用）"""
+        fd = os.open(self._path(key), os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)  # 关闭文件即释放锁
+
+    @asynccontextmanager
+    async def locked(self, key, timeout=10, blocking=True):
+        """异步获取锁，等待期间不阻塞事件循环
+
+        返回值表示是否拿到了锁：blocking为False时拿不到立即返回False，
+        否则最多等待timeout秒，超时后同样返回False，由调用方决定是否继续。
+        """
+        fd = os.open(self._path(key), os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            acquired = False
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    acquired = True
+                    break
+                except BlockingIOError:
+                    if not blocking or time.monotonic() >= deadline:
+                        break
+                    await asyncio.sleep(0.05)
+            yield acquired
+        finally:
+            os.close(fd)
+
+
+class SingleFlight:
+    """合并同一键的并发请求
+
+    同一键在途期间的调用共享同一个任务和结果，任务结束后再来的调用会重新执行。
+    单个调用方被取消不会取消共享任务。
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    def __contains__(self, key):
+        return key in self._calls
+
+    async def do(self, key, func, *args, **kwargs):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        return await asyncio.shield(task)
+
+    async def cancel(self):
+        """取消并等待全部在途任务（插件关闭时使用）"""
+        tasks = list(self._calls.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # 所有调用方都已取消时也要取走异常，避免"exception was never retrieved"警告
+        if not task.cancelled():
+            task.exception()
+
+
+class NegativeCache:
+    """失败结果的短期缓存
+
+    记录最近失败过的键，ttl 秒内再次请求时直接视为失败，不再重复尝试；
+    最多保留 max_entries 个键，超出时淘汰最早加入的。
+    """
+
+    def __init__(self, ttl=60, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def __contains__(self, key):
+        expires = self._entries.get(key)
+        if expires is None:
+            return False
+        if time.monotonic() >= expires:
+            del self._entries[key]
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key, ttl=None):
+        self._entries.pop(key, None)
+        self._entries[key] = time.monotonic() + (self.ttl if ttl is None else ttl)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+
+
+class RenderCache:
+    """已渲染表情的LRU缓存
+
+    内存层按字节数淘汰最久未使用的条目；可选的磁盘层把结果保存在
+    disk_dir 下，重启后仍可命中，过期时间为 disk_ttl 秒。
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, disk_dir=None, disk_ttl=86400):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_ttl = disk_ttl
+        self._entries = OrderedDict()
+        self._size = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(emoji_type, image_hashes, args=None):
+        """根据表情类型、输入图片的内容哈希和渲染参数生成缓存键"""
+        digest = hashlib.sha1(emoji_type.encode("utf-8"))
+        for image_hash in image_hashes:
+            digest.update(b"\0")
+            digest.update(image_hash.encode("ascii"))
+        digest.update(b"\0")
+        digest.update(json.dumps(args or {}, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        return digest.hexdigest()
+
+    @property
+    def size(self):
+        """内存层当前占用的字节数"""
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.img")
+
+    def get(self, key):
+        """读取缓存，未命中返回None"""
+        data = self._entries.get(key)
+        if data is not None:
+            self._entries.move_to_end(key)
+            return data
+
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.disk_ttl:
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        self._store(key, data)
+        return data
+
+    def put(self, key, data):
+        """写入缓存"""
+        self._store(key, data)
+        if self.disk_dir:
+            try:
+                atomic_write(self._disk_path(key), data)
+            except OSError as e:
+                logger.warning(f"写入表情磁盘缓存失败: {str(e)}")
+
+    def _store(self, key, data):
+        # 单个结果超过总容量时不进入内存层
+        if len(data) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= len(old)
+        self._entries[key] = data
+        self._size += len(data)
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+
+    def cleanup_disk(self):
+        """删除磁盘层中过期的结果，返回删除的文件数"""
+        if not self.disk_dir:
+            return 0
+        removed = 0
+        now = time.time()
+        for filename in os.listdir(self.disk_dir):
+            path = os.path.join(self.disk_dir, filename)
+            try:
+                if now - os.path.getmtime(path) > self.disk_ttl:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+        return removed
+
+
+class AvatarImageCache:
+    """预处理后头像的LRU缓存
+
+    键为头像文件的(路径, 修改时间, 大小)，值为(原始内容哈希, 预处理后的图片字节)，
+    按图片字节总数淘汰最久未使用的条目。
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+
+    @staticmethod
+    def file_key(path):
+        """根据文件状态生成缓存键，文件被替换后自动失效"""
+        stat = os.stat(path)
+        return path, stat.st_mtime_ns, stat.st_size
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        return self._size
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, content_hash, data):
+        if len(data) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= len(old[1])
+        self._entries[key] = (content_hash, data)
+        self._size += len(data)
+        while self._size > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+
+
+class AvatarIndex:
+    """头像缓存元数据索引
+
+    用一个SQLite文件记录每个wxid的头像标记、来源、最后更新时间、最后使用时间、
+    使用次数和内容哈希，替代每个头像旁边的 .mark/.update/.count 小文件。
+    头像文件按内容哈希存储，多个wxid可以指向同一个文件；同时记录下载地址、
+    ETag和Last-Modified，用于条件请求刷新。
+    """
+
+    # 旧版本每个头像使用的元数据小文件
+    LEGACY_EXTS = (".mark", ".update", ".count")
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS avatars (
+                wxid TEXT PRIMARY KEY,
+                mark TEXT NOT NULL DEFAULT 'default',
+                source TEXT,
+                updated_at REAL NOT NULL DEFAULT 0,
+                last_used REAL NOT NULL DEFAULT 0,
+                use_count INTEGER NOT NULL DEFAULT 0,
+                content_hash TEXT,
+                size INTEGER NOT NULL DEFAULT 0
+            )"""
+        )
+        # 旧版本索引缺少的列
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(avatars)")}
+        for column in ("url", "etag", "last_modified"):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE avatars ADD COLUMN {column} TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_avatars_cleanup ON avatars (use_count, updated_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_avatars_hash ON avatars (content_hash)")
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def get(self, wxid):
+        """读取头像元数据，不存在返回None"""
+        rows = self._execute("SELECT * FROM avatars WHERE wxid = ?", (wxid,))
+        return dict(rows[0]) if rows else None
+
+    def record_download(self, wxid, mark, source=None, content_hash=None, size=0,
+                        url=None, etag=None, last_modified=None):
+        """记录一次头像下载"""
+        self._execute(
+            """INSERT INTO avatars (wxid, mark, source, updated_at, content_hash, size, url, etag, last_modified)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT (wxid) DO UPDATE SET
+                   mark = excluded.mark, source = excluded.source, updated_at = excluded.updated_at,
+                   content_hash = excluded.content_hash, size = excluded.size, url = excluded.url,
+                   etag = excluded.etag, last_modified = excluded.last_modified""",
+            (wxid, mark, source, time.time(), content_hash, size, url, etag, last_modified),
+        )
+
+    def record_refresh(self, wxid, mark=None):
+        """头像内容未变化时只刷新更新时间（和标记）"""
+        self._execute(
+            "UPDATE avatars SET updated_at = ?, mark = COALESCE(?, mark) WHERE wxid = ?",
+            (time.time(), mark, wxid),
+        )
+
+    def set_content(self, wxid, content_hash, size):
+        """记录头像的内容哈希（迁移旧头像文件时使用）"""
+        self._execute(
+            """INSERT INTO avatars (wxid, content_hash, size) VALUES (?, ?, ?)
+               ON CONFLICT (wxid) DO UPDATE SET content_hash = excluded.content_hash, size = excluded.size""",
+            (wxid, content_hash, size),
+        )
+
+    def count_hash(self, content_hash):
+        """返回引用该内容哈希的wxid数量"""
+        rows = self._execute("SELECT COUNT(*) AS n FROM avatars WHERE content_hash = ?", (content_hash,))
+        return rows[0]["n"]
+
+    def touch(self, wxid):
+        """使用次数加一并记录最后使用时间"""
+        self._execute(
+            """INSERT INTO avatars (wxid, last_used, use_count) VALUES (?, ?, 1)
+               ON CONFLICT (wxid) DO UPDATE SET last_used = excluded.last_used, use_count = use_count + 1""",
+            (wxid, time.time()),
+        )
+
+    def find_expired(self, max_count, updated_before):
+        """查找使用次数少于max_count且在updated_before之前更新的wxid"""
+        rows = self._execute(
+            "SELECT wxid FROM avatars WHERE use_count < ? AND updated_at < ?",
+            (max_count, updated_before),
+        )
+        return [row["wxid"] for row in rows]
+
+    def disk_usage(self):
+        """返回(头像文件数, 总字节数)，内容相同的头像只计一次"""
+        rows = self._execute(
+            """SELECT COUNT(*) AS files, COALESCE(SUM(size), 0) AS bytes FROM (
+                   SELECT MAX(size) AS size FROM avatars
+                   WHERE content_hash IS NOT NULL GROUP BY content_hash
+               )"""
+        )
+        return rows[0]["files"], rows[0]["bytes"]
+
+    def eviction_candidates(self, limit, policy="lru", used_before=None):
+        """按淘汰顺序返回最多limit个有头像文件的wxid
+
+        lru 按最后使用时间从早到晚，lfu 按使用次数从少到多（次数相同时先淘汰久未使用的）；
+        used_before 不为空时跳过在该时间之后使用过的头像。
+        """
+        order = "use_count, last_used" if policy == "lfu" else "last_used, use_count"
+        rows = self._execute(
+            f"""SELECT wxid FROM avatars
+                WHERE content_hash IS NOT NULL AND last_used < ?
+                ORDER BY {order} LIMIT ?""",
+            (float("inf") if used_before is None else used_before, limit),
+        )
+        return [row["wxid"] for row in rows]
+
+    def delete(self, wxids):
+        """删除多个wxid的元数据"""
+        with self._lock:
+            self._conn.executemany("DELETE FROM avatars WHERE wxid = ?", [(wxid,) for wxid in wxids])
+
+    def import_legacy(self, avatar_dir):
+        """导入旧版本的 .mark/.update/.count 元数据文件并删除，返回导入的头像数"""
+        legacy = {}
+        with os.scandir(avatar_dir) as entries:
+            for entry in entries:
+                wxid, ext = os.path.splitext(entry.name)
+                if ext in self.LEGACY_EXTS and entry.is_file():
+                    legacy.setdefault(wxid, {})[ext] = entry.path
+        if not legacy:
+            return 0
+
+        def read(path, convert, default):
+            try:
+                with open(path, "r") as f:
+                    return convert(f.read().strip())
+            except (OSError, ValueError, TypeError):
+                return default
+
+        rows = []
+        for wxid, files in legacy.items():
+            avatar_path = os.path.join(avatar_dir, f"{wxid}.jpg")
+            if os.path.exists(avatar_path):
+                rows.append((
+                    wxid,
+                    read(files.get(".mark"), str, "default"),
+                    read(files.get(".update"), float, 0.0),
+                    read(files.get(".count"), int, 0),
+                    os.path.getsize(avatar_path),
+                ))
+        with self._lock:
+            self._conn.executemany(
+                """INSERT OR IGNORE INTO avatars (wxid, mark, updated_at, use_count, size)
+                   VALUES (?, ?, ?, ?, ?)""",
+                rows,
+            )
+        for files in legacy.values():
+            for path in files.values():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -5,15 +5,42 @@ import io
 import re
 import json
 import random
+import hashlib
+import sqlite3
 import aiohttp
 import asyncio
 import time
-from PIL import Image
+import contextlib
+from collections import Counter, OrderedDict
+from types import MappingProxyType
 
 from WechatAPI import WechatAPIClient
 from utils.decorators import *
 from utils.plugin_base import PluginBase
-from meme_generator import get_meme
+
+from .breaker import CircuitBreaker
+from .cache import AvatarImageCache, AvatarIndex, FileLock, NegativeCache, RenderCache, SingleFlight, atomic_write
+from .metrics import MemeMetrics
+from .render import MemeRenderer, RenderQueueFull, normalize_avatar
+from .prerender import PreviewGallery
+from .scheduler import RenderScheduler
+from .snapshot import file_mtimes, load_snapshot
+
+
+# 微信@提及格式为"@昵称"加四分之一em空格（\u2005）
+AT_MENTION_PATTERN = re.compile(r'@[^@\u2005]+\u2005')
+# 表情启用/禁用命令
+TOGGLE_COMMAND_PATTERN = re.compile(r'^(全局)?(禁用|启用)表情\s+(.+)$')
+# 清理缓存命令前缀
+CLEAR_CACHE_PREFIXES = ("清理表情缓存", "清除表情缓存")
+# 查看性能指标命令
+METRICS_COMMANDS = ("表情统计",)
+# 所有管理命令前缀，用于快速过滤
+COMMAND_PREFIXES = CLEAR_CACHE_PREFIXES + METRICS_COMMANDS + ("禁用表情", "启用表情", "全局禁用表情", "全局启用表情")
+# 头像获取途径，每个途径各有一个熔断器
+AVATAR_SOURCES = ("get_contact", "chatroom_member", "get_profile", "download")
+# 分批淘汰头像时两批之间的间隔（秒）
+EVICTION_BATCH_PAUSE = 0.05
 
 
 class MemeGen(PluginBase):
@@ -35,6 +62,12 @@ class MemeGen(PluginBase):
             # 读取基本配置
             basic_config = config.get("basic", {})
             self.enable = basic_config.get("enable", True)
+            self.use_filehelper_cache = basic_config.get("use_filehelper_cache", True)
+            self.filehelper_wxid = basic_config.get("filehelper_wxid", "filehelper")
+            self.filehelper_min_hits = basic_config.get("filehelper_min_hits", 2)  # 默认第2次请求时上传
+            self.media_cache_size = basic_config.get("media_cache_size", 1000)  # 默认记住1000个已上传表情
+            self.filehelper_retry_after = basic_config.get("filehelper_retry_after", 3600)  # 默认1小时
+            self.filehelper_max_timeouts = basic_config.get("filehelper_max_timeouts", 5)  # 默认连续5次
             
             # 读取缓存配置
             cache_config = config.get("cache", {})
@@ -43,71 +76,326 @@ class MemeGen(PluginBase):
             self.cleanup_interval = cache_config.get("cleanup_interval", 24)  # 默认24小时
             self.cleanup_threshold = cache_config.get("cleanup_threshold", 3)  # 默认3次
             self.cleanup_expire_days = cache_config.get("cleanup_expire_days", 7)  # 默认7天
+            self.gif_cache_wait = cache_config.get("gif_cache_wait", 1)  # 默认1秒
+            self.member_index_ttl = cache_config.get("member_index_ttl", 3600)  # 默认1小时
+            self.member_refresh_interval = cache_config.get("member_refresh_interval", 60)  # 默认60秒
+            self.member_warm_avatars = cache_config.get("warm_group_avatars", False)
+            self.member_warm_concurrency = cache_config.get("warm_concurrency", 4)
+            self.skip_unchanged_url = cache_config.get("skip_unchanged_url", True)
+            self.avatar_max_mb = cache_config.get("max_disk_mb", 512)  # 默认头像最多占用512MB
+            self.avatar_max_files = cache_config.get("max_files", 20000)  # 默认最多20000个头像文件
+            self.eviction_policy = cache_config.get("eviction_policy", "lru")  # lru或lfu
+            self.eviction_batch_size = cache_config.get("eviction_batch_size", 100)  # 每批最多删除100个
+            
+            # 管理员和命令配置随表情配置一起放在配置快照中，修改后自动重新加载
+            
+            # 读取渲染配置
+            render_config = config.get("render", {})
+            self.render_workers = render_config.get("workers", 2)  # 默认2个工作进程
+            self.render_queue_size = render_config.get("queue_size", 8)  # 默认排队8个任务
+            self.render_timeout = render_config.get("timeout", 30)  # 默认30秒
+            self.avatar_size = render_config.get("avatar_size", 512)  # 默认头像预处理为512x512
+            self.avatar_image_cache_mb = render_config.get("avatar_cache_mb", 32)  # 默认32MB
+            self.warmup_templates = render_config.get("warmup_templates", 10)  # 默认预热最常用的10个表情
+            
+            # 读取输出优化配置
+            self.optimize_config = config.get("optimize", {})
+            
+            # 读取调度配置
+            schedule_config = config.get("schedule", {})
+            self.schedule_concurrency = schedule_config.get("concurrency", self.render_workers or 1)  # 默认与工作进程数相同
+            self.schedule_max_queue = schedule_config.get("max_queue", 32)  # 默认最多排队32个任务
+            self.group_rate = schedule_config.get("group_rate", 0.5)  # 默认每个群每2秒1次
+            self.group_burst = schedule_config.get("group_burst", 5)  # 默认每个群可连续5次
+            self.user_rate = schedule_config.get("user_rate", 0.2)  # 默认每个用户每5秒1次
+            self.user_burst = schedule_config.get("user_burst", 3)  # 默认每个用户可连续3次
+            
+            # 读取批量表情配置
+            batch_config = config.get("batch", {})
+            self.batch_enable = batch_config.get("enable", True)
+            self.batch_mode = batch_config.get("mode", "grid")  # grid拼成一张图，separate逐张发送
+            self.batch_max_targets = batch_config.get("max_targets", 9)  # 默认最多9人
+            self.batch_columns = batch_config.get("columns", 0)  # 默认自动排列
+            self.batch_cell_size = batch_config.get("cell_size", 240)  # 默认每格240像素
+            
+            # 读取表情预览图配置
+            preview_config = config.get("preview", {})
+            self.preview_enable = preview_config.get("enable", True)
+            self.preview_auto_build = preview_config.get("auto_build", True)
+            self.preview_options = {
+                "columns": preview_config.get("columns", 6),  # 默认每行6个
+                "cell_size": preview_config.get("cell_size", 200),  # 默认每格200像素
+                "per_page": preview_config.get("per_page", 36),  # 默认每页36个
+                "font": preview_config.get("font", ""),
+            }
+            
+            # 读取多实例共享缓存配置
+            shared_config = config.get("shared", {})
+            self.shared_dir = shared_config.get("dir", "")  # 默认不共享
+            self.shared_lock_timeout = shared_config.get("lock_timeout", 10)  # 默认最多等待10秒
             
-            # 读取管理员配置
-            admin_config = config.get("admin", {})
-            self.local_admin_users = admin_config.get("admin_users", [])
+            # 读取容错配置
+            resilience_config = config.get("resilience", {})
+            self.request_deadline = resilience_config.get("request_deadline", 20)  # 默认20秒
+            self.negative_ttl = resilience_config.get("negative_ttl", 60)  # 默认60秒
+            self.breaker_failures = resilience_config.get("breaker_failures", 5)  # 默认连续失败5次熔断
+            self.breaker_cooldown = resilience_config.get("breaker_cooldown", 30)  # 默认冷却30秒
             
-            # 读取命令配置
-            commands_config = config.get("commands", {})
-            self.list_commands = commands_config.get("list_commands", ["表情列表"])
+            # 读取发送配置
+            send_config = config.get("send", {})
+            self.send_interval = send_config.get("interval", 0.5)  # 默认0.5秒
+            
+            # 读取网络配置
+            http_config = config.get("http", {})
+            self.http_limit = http_config.get("limit", 32)  # 默认最多32个连接
+            self.http_limit_per_host = http_config.get("limit_per_host", 8)  # 默认每个主机8个连接
+            self.http_timeout = http_config.get("timeout", 10)  # 默认10秒
+            self.http_keepalive = http_config.get("keepalive_timeout", 30)  # 默认空闲连接保持30秒
+            
+            # 读取表情结果缓存配置
+            render_cache_config = config.get("render_cache", {})
+            self.render_cache_enable = render_cache_config.get("enable", True)
+            self.render_cache_max_mb = render_cache_config.get("memory_max_mb", 64)  # 默认64MB
+            self.render_cache_disk = render_cache_config.get("disk_cache", True)
+            self.render_cache_disk_ttl = render_cache_config.get("disk_ttl", 24)  # 默认24小时
             
         except Exception as e:
             logger.error(f"加载MemeGen配置文件失败: {str(e)}")
             self.enable = False
+            self.use_filehelper_cache = False
+            self.filehelper_wxid = "filehelper"
+            self.filehelper_min_hits = 2
+            self.media_cache_size = 1000
+            self.filehelper_retry_after = 3600
+            self.filehelper_max_timeouts = 5
+            self.gif_cache_wait = 1
             self.real_avatar_ttl = 86400
             self.default_avatar_ttl = 43200
             self.cleanup_interval = 24
             self.cleanup_threshold = 3
             self.cleanup_expire_days = 7
-            self.local_admin_users = []
-            self.list_commands = ["表情列表"]
+            self.member_index_ttl = 3600
+            self.member_refresh_interval = 60
+            self.member_warm_avatars = False
+            self.member_warm_concurrency = 4
+            self.skip_unchanged_url = True
+            self.avatar_max_mb = 512
+            self.avatar_max_files = 20000
+            self.eviction_policy = "lru"
+            self.eviction_batch_size = 100
+            self.render_workers = 2
+            self.render_queue_size = 8
+            self.render_timeout = 30
+            self.avatar_size = 512
+            self.avatar_image_cache_mb = 32
+            self.warmup_templates = 10
+            self.optimize_config = {}
+            self.schedule_concurrency = 2
+            self.schedule_max_queue = 32
+            self.group_rate = 0.5
+            self.group_burst = 5
+            self.user_rate = 0.2
+            self.user_burst = 3
+            self.batch_enable = True
+            self.batch_mode = "grid"
+            self.batch_max_targets = 9
+            self.batch_columns = 0
+            self.batch_cell_size = 240
+            self.preview_enable = False
+            self.preview_auto_build = False
+            self.preview_options = {}
+            self.shared_dir = ""
+            self.shared_lock_timeout = 10
+            self.request_deadline = 20
+            self.negative_ttl = 60
+            self.breaker_failures = 5
+            self.breaker_cooldown = 30
+            self.send_interval = 0.5
+            self.http_limit = 32
+            self.http_limit_per_host = 8
+            self.http_timeout = 10
+            self.http_keepalive = 30
+            self.render_cache_enable = False
+            self.render_cache_max_mb = 64
+            self.render_cache_disk = False
+            self.render_cache_disk_ttl = 24
+            self.renderer = None
+            self.scheduler = None
+            self.render_cache = None
+            self.avatar_index = None
+            self.http_session = None
+            self.background_tasks = set()
+            self.upload_flight = SingleFlight()
+            self.avatar_flight = SingleFlight()
+            self.member_flight = SingleFlight()
             return
             
-        # 创建临时文件夹
-        self.temp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp")
+        # 创建临时文件夹（可通过MEMEGEN_TEMP_DIR环境变量指定，供基准测试等隔离使用）
+        self.temp_dir = os.environ.get("MEMEGEN_TEMP_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp")
         os.makedirs(self.temp_dir, exist_ok=True)
         
+        # 头像和表情缓存的根目录：配置了共享目录时多个机器人实例共用同一份缓存
+        self.cache_dir = self.temp_dir
+        self.shared_lock = None
+        if self.shared_dir:
+            if FileLock.available:
+                self.cache_dir = self.shared_dir
+                self.shared_lock = FileLock(os.path.join(self.shared_dir, "locks"))
+                logger.info(f"MemeGen使用共享缓存目录: {self.shared_dir}")
+            else:
+                logger.warning("当前系统不支持文件锁，无法使用共享缓存目录，改用本实例的缓存")
+        
         # 创建头像缓存目录
-        self.avatar_dir = os.path.join(self.temp_dir, "avatars")
+        self.avatar_dir = os.path.join(self.cache_dir, "avatars")
         os.makedirs(self.avatar_dir, exist_ok=True)
         
-        # 加载表情配置
-        self.meme_cache = {}  # 用于缓存meme生成器
+        # 旧数据迁移只能由一个实例执行
+        with self.shared_lock.hold("startup") if self.shared_lock else contextlib.nullcontext():
+            # 打开头像元数据索引，并导入旧版本的元数据小文件
+            self.avatar_index = AvatarIndex(os.path.join(self.avatar_dir, "index.db"))
+            imported = self.avatar_index.import_legacy(self.avatar_dir)
+            if imported:
+                logger.info(f"已将 {imported} 个头像的旧版元数据导入索引")
+            
+            # 头像文件按内容哈希存储，相同头像只保存一份
+            self.blob_dir = os.path.join(self.avatar_dir, "blobs")
+            os.makedirs(self.blob_dir, exist_ok=True)
+            migrated = self.migrate_legacy_avatars()
+            if migrated:
+                logger.info(f"已将 {migrated} 个旧版头像文件迁移为按内容存储")
+        
+        # 创建渲染引擎（进程池在async_init中启动）
+        self.renderer = MemeRenderer(self.render_workers, self.render_queue_size, self.render_timeout)
+        
+        # 各表情的累计使用次数，用于启动时预热最常用的表情
+        self.template_usage_path = os.path.join(self.temp_dir, "template_usage.json")
+        self.template_usage = self.load_template_usage()
+        
+        # 创建渲染调度器（限流、按群轮询、合并重复请求）
+        self.scheduler = RenderScheduler(
+            self.schedule_concurrency, self.schedule_max_queue,
+            self.group_rate, self.group_burst, self.user_rate, self.user_burst,
+        )
+        
+        # 发送节流
+        self.send_lock = asyncio.Lock()
+        self.last_send_time = 0.0
+        
+        # 文件助手媒体缓存：已上传表情的图片消息XML，格式: {缓存键: xml}
+        self.media_handles = OrderedDict()
+        self.render_hits = OrderedDict()  # 各表情结果的请求次数
+        self.pending_uploads = {}  # 等待文件助手回显的上传，格式: {消息ID: future}
+        self.pending_upload_digests = {}  # 拿不到消息ID时按图片MD5匹配回显，格式: {md5: future}
+        self.upload_flight = SingleFlight()
+        self.upload_failures = NegativeCache(self.filehelper_retry_after, self.media_cache_size)  # 回显失败的表情
+        self.filehelper_timeouts = 0  # 连续等待回显超时的次数
+        
+        # 创建表情结果缓存
+        self.render_cache = None
+        if self.render_cache_enable:
+            self.render_cache = RenderCache(
+                max_bytes=int(self.render_cache_max_mb * 1024 * 1024),
+                disk_dir=os.path.join(self.cache_dir, "renders") if self.render_cache_disk else None,
+                disk_ttl=self.render_cache_disk_ttl * 3600,
+            )
+        
+        # 预处理后头像的内存缓存
+        self.avatar_images = AvatarImageCache(int(self.avatar_image_cache_mb * 1024 * 1024))
+        
+        # 共享的HTTP会话（在async_init中创建）
+        self.http_session = None
+        
+        # 合并同一头像、同一表情的并发请求
+        self.avatar_flight = SingleFlight()
+        self.member_flight = SingleFlight()
+        
+        # 头像获取失败的负缓存，键为wxid、(来源, wxid)或("download", 头像URL)
+        self.negative_cache = NegativeCache(self.negative_ttl)
+        
+        # 各头像接口的熔断器
+        self.breakers = {
+            source: CircuitBreaker(self.breaker_failures, self.breaker_cooldown)
+            for source in AVATAR_SOURCES
+        }
+        
+        # 群成员头像索引，格式: {chatroom: {"updated": 时间戳, "members": {wxid: (头像URL, 标记)}}}
+        self.chatroom_members = {}
+        
+        # 后台任务引用
+        self.background_tasks = set()
+        self.quota_task = None  # 正在执行的头像磁盘配额检查
+        
+        # 性能指标
+        self.metrics = MemeMetrics()
+        self.metrics.set_gauge("render_queue_depth", lambda: self.renderer.pending)
+        self.metrics.set_gauge("render_pool_utilization", lambda: round(min(1.0, self.renderer.pending / max(1, self.renderer.workers)), 3))
+        self.metrics.set_gauge("render_cache_bytes", lambda: self.render_cache.size if self.render_cache is not None else 0)
+        self.metrics.set_gauge("avatar_image_cache_bytes", lambda: self.avatar_images.size)
+        self.metrics.set_gauge("schedule_queued", lambda: self.scheduler.queued)
+        self.metrics.set_gauge("schedule_running", lambda: self.scheduler.running)
+        self.metrics.set_gauge("background_tasks", lambda: len(self.background_tasks))
+        self.metrics.set_gauge("negative_cache_entries", lambda: len(self.negative_cache))
+        self.metrics.set_gauge("open_breakers", lambda: sum(
+            breaker.state != CircuitBreaker.CLOSED for breaker in self.breakers.values()
+        ))
+        
+        # 加载配置快照（表情、管理员、命令和禁用状态）
+        plugin_dir = os.path.dirname(os.path.abspath(__file__))
+        self.config_paths = (
+            os.path.join(plugin_dir, "emoji.json"),
+            config_path,
+            os.path.join(os.path.dirname(plugin_dir), "config.json"),
+        )
+        self.config_failed_mtimes = None  # 加载失败的文件版本，避免重复报错
+        self.config = None
         try:
             self.load_emoji_config()
         except Exception as e:
             logger.error(f"加载表情配置失败: {str(e)}")
             self.enable = False
+        
+        # 表情预览图，emoji.json或meme_generator版本变化后重新生成
+        self.gallery = PreviewGallery(os.path.join(self.cache_dir, "preview"), self.config_paths[0], self.preview_options)
+        self.gallery_task = None
             
     def load_emoji_config(self):
-        """加载表情配置文件"""
-        emoji_path = os.path.join(os.path.dirname(__file__), "emoji.json")
-        if not os.path.exists(emoji_path):
-            logger.error(f"表情配置文件不存在: {emoji_path}")
-            raise FileNotFoundError(f"表情配置文件不存在: {emoji_path}")
-            
-        with open(emoji_path, "r", encoding="utf-8") as f:
-            emoji_config = json.load(f)
-        
-        # 单人表情
-        self.single_emojis = emoji_config.get("one_PicEwo", {})
-        # 双人表情
-        self.two_person_emojis = emoji_config.get("two_PicEwo", {})
+        """加载表情配置文件并构建配置快照"""
+        self.config = load_snapshot(*self.config_paths)
+        logger.info(f"成功加载表情配置，单人表情: {len(self.config.single_emojis)}，双人表情: {len(self.config.two_person_emojis)}")
+
+    async def reload_config_snapshot(self):
+        """配置文件有变化时在后台线程重建配置快照并整体替换，返回是否已替换"""
+        mtimes = file_mtimes(self.config_paths)
+        if mtimes == self.config.mtimes or mtimes == self.config_failed_mtimes:
+            return False
         
-        # 创建禁用表情追踪
-        self.disabled_emojis = {}  # 格式: {group_id: set(disabled_meme_types)}
-        self.globally_disabled_emojis = set()  # 全局禁用的表情类型
+        try:
+            snapshot = await asyncio.to_thread(load_snapshot, *self.config_paths)
+        except Exception as e:
+            logger.error(f"重新加载MemeGen配置失败，继续使用旧配置: {str(e)}")
+            self.config_failed_mtimes = mtimes
+            return False
         
-        logger.info(f"成功加载表情配置，单人表情: {len(self.single_emojis)}，双人表情: {len(self.two_person_emojis)}")
+        # 启用/禁用状态是运行时状态，替换时沿用当前快照中的值
+        current = self.config
+        self.config = snapshot._replace(
+            globally_disabled=current.globally_disabled, group_disabled=current.group_disabled
+        )
+        self.config_failed_mtimes = None
+        logger.info(f"MemeGen配置已重新加载，单人表情: {len(snapshot.single_emojis)}，双人表情: {len(snapshot.two_person_emojis)}，管理员: {len(snapshot.admin_users)}")
+        return True
 
     @on_text_message()
     async def handle_text(self, bot: WechatAPIClient, message: dict):
         """处理文本消息"""
         if not self.enable:
-            logger.info("MemeGen插件已禁用，忽略消息")
+            return
+        
+        # 快速过滤：不可能是本插件命令的消息直接返回，不做日志和正则
+        if not self.may_handle(message):
             return
             
+        config = self.config
         content = message.get("Content", "").strip()
         from_wxid = message.get("FromWxid", "")
         is_group = message.get("IsGroup", False)
@@ -116,15 +404,14 @@ class MemeGen(PluginBase):
         logger.info(f"MemeGen收到消息: {content}, 来自: {from_wxid}, 实际发送者: {actual_user_id}")
         
         # 检查是否请求表情列表
-        if content in self.list_commands:
+        if content in config.list_command_set:
             await self.send_emoji_list(bot, from_wxid)
             return
             
         # 处理清理头像缓存命令
-        if content.startswith("清理表情缓存") or content.startswith("清除表情缓存"):
+        if content.startswith(CLEAR_CACHE_PREFIXES):
             # 检查权限
-            admin_users = self.get_admin_users()
-            if actual_user_id not in admin_users:
+            if actual_user_id not in config.admin_users:
                 await bot.send_text_message(from_wxid, "只有管理员才能执行此操作！")
                 return
                 
@@ -148,8 +435,17 @@ class MemeGen(PluginBase):
                 await bot.send_text_message(from_wxid, f"清理缓存失败: {str(e)}")
                 return
             
+        # 查看性能指标
+        if content in METRICS_COMMANDS:
+            if actual_user_id not in config.admin_users:
+                await bot.send_text_message(from_wxid, "只有管理员才能执行此操作！")
+                return
+            self.dump_metrics_file()
+            await bot.send_text_message(from_wxid, self.metrics.summary())
+            return
+            
         # 检查是否是表情启用/禁用命令
-        if re.match(r'^(全局)?(禁用|启用)表情\s+.+$', content):
+        if TOGGLE_COMMAND_PATTERN.match(content):
             await self.handle_enable_disable_commands(bot, message)
             return
             
@@ -168,196 +464,806 @@ class MemeGen(PluginBase):
         clean_content = self.clean_at_text(content)
         logger.info(f"清理@后的内容: {clean_content}")
         
+        # 在清理后的内容中查找最长触发词，找不到时再扫描原始内容（兼容手动输入的@）
+        def find_trigger(matcher):
+            return matcher.find_longest(clean_content) or matcher.find_longest(content)
+        
+        # 双人表情需要至少两个@用户；@多个用户但触发词是单人表情时进入批量模式
+        batch = False
+        if len(at_users) >= 2:
+            match = find_trigger(config.two_person_matcher)
+            if not match and self.batch_enable:
+                match = find_trigger(config.single_matcher)
+                batch = match is not None
+        else:
+            match = find_trigger(config.single_matcher)
+        if not match:
+            logger.info("消息处理完毕，没有找到匹配的表情生成条件")
+            return
+        trigger_word, emoji_type = match
+        
         # 检查表情是否被禁用
         group_id = from_wxid if is_group else None
-        if (clean_content in self.globally_disabled_emojis or 
-            (group_id in self.disabled_emojis and clean_content in self.disabled_emojis[group_id])):
-            logger.info(f"表情 {clean_content} 已被禁用，不处理")
+        if config.is_disabled(trigger_word, group_id):
+            logger.info(f"表情 {trigger_word} 已被禁用，不处理")
+            return
+        
+        # 按群和按用户限流
+        if not self.scheduler.allow(from_wxid, actual_user_id or from_wxid):
+            logger.info(f"请求过于频繁，忽略表情请求: {from_wxid}, {actual_user_id}")
+            self.metrics.inc("rate_limited")
             return
         
+        with self.metrics.span("total", emoji_type):
+            if batch:
+                await self.process_batch_request(bot, from_wxid, group_id, at_users, trigger_word, emoji_type)
+            else:
+                await self.process_meme_request(bot, from_wxid, group_id, at_users, trigger_word, emoji_type)
+
+    async def process_meme_request(self, bot, from_wxid, group_id, at_users, trigger_word, emoji_type):
+        """获取被@用户的头像，生成并发送表情
+        
+        获取头像和渲染共用 request_deadline 秒的时限，超时即放弃本次请求（发送不计入时限）。
+        """
+        deadline = asyncio.get_running_loop().time() + self.request_deadline
+        
         # 处理双人表情：格式为 "@用户A 触发词 @用户B"
         if len(at_users) >= 2:
-            logger.info("检测到至少两个@用户，尝试生成双人表情")
-            # 尝试查找双人表情触发词
-            for trigger_word, emoji_type in self.two_person_emojis.items():
-                if trigger_word in content:
-                    logger.info(f"找到双人表情触发词: {trigger_word}, 类型: {emoji_type}")
-                    # 获取第一个被@用户的头像
-                    first_avatar = await self.download_avatar(bot, at_users[0], from_wxid if is_group else None)
-                    if not first_avatar:
-                        await bot.send_text_message(from_wxid, f"无法获取用户 {at_users[0]} 的头像")
-                        return
-                    
-                    # 获取第二个被@用户的头像
-                    second_avatar = await self.download_avatar(bot, at_users[1], from_wxid if is_group else None)
-                    if not second_avatar:
-                        await bot.send_text_message(from_wxid, f"无法获取用户 {at_users[1]} 的头像")
-                        return
-                    
-                    # 生成并发送双人表情
-                    await self.generate_and_send_meme(bot, from_wxid, emoji_type, [first_avatar, second_avatar], two_person=True)
-                    logger.info(f"生成双人表情：{trigger_word}，使用用户 {at_users[0]} 和 {at_users[1]} 的头像")
-                    return
+            logger.info(f"找到双人表情触发词: {trigger_word}, 类型: {emoji_type}")
+            # 并发获取两个被@用户的头像
+            try:
+                async with asyncio.timeout_at(deadline):
+                    first_avatar, second_avatar = await asyncio.gather(
+                        self.download_avatar(bot, at_users[0], group_id),
+                        self.download_avatar(bot, at_users[1], group_id),
+                    )
+            except TimeoutError:
+                logger.warning(f"获取头像超时: {at_users[0]}, {at_users[1]}")
+                self.metrics.inc("deadline_exceeded", stage="avatar")
+                await bot.send_text_message(from_wxid, "获取头像超时，请稍后再试")
+                return
+            if not first_avatar:
+                await bot.send_text_message(from_wxid, f"无法获取用户 {at_users[0]} 的头像")
+                return
             
-            logger.info("未找到匹配的双人表情触发词")
+            if not second_avatar:
+                await bot.send_text_message(from_wxid, f"无法获取用户 {at_users[1]} 的头像")
+                return
+            
+            # 生成并发送双人表情
+            await self.generate_and_send_meme(
+                bot, from_wxid, emoji_type, [first_avatar, second_avatar], two_person=True, deadline=deadline
+            )
+            logger.info(f"生成双人表情：{trigger_word}，使用用户 {at_users[0]} 和 {at_users[1]} 的头像")
+            return
                 
         # 处理单人表情：格式为 "@用户 触发词"
-        if len(at_users) == 1:
-            logger.info("检测到一个@用户，尝试生成单人表情")
-            # 检查消息中的所有单人表情触发词
-            for trigger_word, emoji_type in self.single_emojis.items():
-                if trigger_word in content:
-                    logger.info(f"找到单人表情触发词: {trigger_word}, 类型: {emoji_type}")
-                    # 获取被@用户的头像
-                    avatar_path = await self.download_avatar(bot, at_users[0], from_wxid if is_group else None)
-                    if avatar_path:
-                        await self.generate_and_send_meme(bot, from_wxid, emoji_type, [avatar_path])
-                        logger.info(f"生成单人表情：{trigger_word}，使用用户 {at_users[0]} 的头像")
-                    else:
-                        await bot.send_text_message(from_wxid, f"无法获取用户 {at_users[0]} 的头像")
-                    return
-            
-            logger.info("未找到匹配的单人表情触发词")
+        logger.info(f"找到单人表情触发词: {trigger_word}, 类型: {emoji_type}")
+        # 获取被@用户的头像
+        try:
+            async with asyncio.timeout_at(deadline):
+                avatar_path = await self.download_avatar(bot, at_users[0], group_id)
+        except TimeoutError:
+            logger.warning(f"获取头像超时: {at_users[0]}")
+            self.metrics.inc("deadline_exceeded", stage="avatar")
+            await bot.send_text_message(from_wxid, "获取头像超时，请稍后再试")
+            return
+        if avatar_path:
+            await self.generate_and_send_meme(bot, from_wxid, emoji_type, [avatar_path], deadline=deadline)
+            logger.info(f"生成单人表情：{trigger_word}，使用用户 {at_users[0]} 的头像")
+        else:
+            await bot.send_text_message(from_wxid, f"无法获取用户 {at_users[0]} 的头像")
+
+    async def process_batch_request(self, bot, from_wxid, group_id, at_users, trigger_word, emoji_type):
+        """为多个被@用户批量生成同一单人表情，头像并发获取"""
+        deadline = asyncio.get_running_loop().time() + self.request_deadline
+        targets = list(dict.fromkeys(at_users))[:self.batch_max_targets]
+        logger.info(f"找到批量表情触发词: {trigger_word}, 类型: {emoji_type}, 共{len(targets)}人")
         
-        logger.info("消息处理完毕，没有找到匹配的表情生成条件")
+        try:
+            async with asyncio.timeout_at(deadline):
+                avatar_paths = await asyncio.gather(
+                    *(self.download_avatar(bot, wxid, group_id) for wxid in targets)
+                )
+        except TimeoutError:
+            logger.warning(f"批量获取头像超时: {targets}")
+            self.metrics.inc("deadline_exceeded", stage="avatar")
+            await bot.send_text_message(from_wxid, "获取头像超时，请稍后再试")
+            return
+        
+        failed = [wxid for wxid, path in zip(targets, avatar_paths) if not path]
+        avatars = [path for path in avatar_paths if path]
+        if failed:
+            await bot.send_text_message(from_wxid, f"无法获取用户 {'、'.join(failed)} 的头像")
+        if not avatars:
+            return
+        
+        await self.generate_and_send_batch(bot, from_wxid, emoji_type, avatars, deadline=deadline)
 
-    async def generate_and_send_meme(self, bot, to_wxid, emoji_type, avatars, two_person=False):
-        """生成并发送表情包"""
+    async def generate_and_send_meme(self, bot, to_wxid, emoji_type, avatars, two_person=False, deadline=None):
+        """生成并发送表情包，deadline为事件循环时间，超过时放弃渲染"""
         try:
-            # 获取或创建meme生成器
-            if emoji_type not in self.meme_cache:
-                self.meme_cache[emoji_type] = get_meme(emoji_type)
-            
-            meme_gen = self.meme_cache[emoji_type]
-            
-            # 生成表情
-            result = meme_gen(images=avatars, texts=[], args={"circle": True})
-            
-            # 处理协程结果
-            if asyncio.iscoroutine(result):
-                buf_gif = await result
-            else:
-                buf_gif = result
+            # 读取头像和渲染受请求时限约束
+            async with asyncio.timeout_at(deadline):
+                cache_key, image_data = await self.render_for_avatars(to_wxid, emoji_type, avatars)
                 
             # 发送表情
-            await bot.send_image_message(to_wxid, buf_gif.getvalue())
+            with self.metrics.span("send", emoji_type):
+                await self.send_meme_image(bot, to_wxid, cache_key, image_data)
             logger.info(f"成功发送表情: {emoji_type}")
             
         except Exception as e:
-            logger.error(f"生成表情失败: {str(e)}")
-            await bot.send_text_message(to_wxid, f"生成表情失败: {str(e)}")
+            await self.report_render_error(bot, to_wxid, emoji_type, e)
 
-    async def download_avatar(self, bot, wxid, from_wxid=None, force_update=False):
-        """下载用户头像并保存到临时目录"""
+    async def generate_and_send_batch(self, bot, to_wxid, emoji_type, avatars, deadline=None):
+        """为多个头像分别生成同一表情，按配置逐张发送或拼成一张网格图发送"""
         try:
-            # 定义头像文件路径
-            avatar_path = os.path.join(self.avatar_dir, f"{wxid}.jpg")
-            
-            # 创建缓存目录
-            os.makedirs(self.avatar_dir, exist_ok=True)
+            async with asyncio.timeout_at(deadline):
+                # 各头像的渲染任务同时提交，由调度器分配到各工作进程
+                results = await asyncio.gather(
+                    *(self.render_for_avatars(to_wxid, emoji_type, [avatar]) for avatar in avatars),
+                    return_exceptions=True,
+                )
+                rendered = [result for result in results if not isinstance(result, BaseException)]
+                if not rendered:
+                    raise results[0]
+                if len(rendered) < len(results):
+                    logger.warning(f"批量表情部分生成失败: {emoji_type}，成功{len(rendered)}/{len(results)}")
+                
+                if self.batch_mode == "grid" and len(rendered) > 1:
+                    rendered = [await self.compose_batch(to_wxid, emoji_type, rendered)]
             
-            avatar_url = None
-            avatar_source = "未知"
+            with self.metrics.span("send", emoji_type):
+                for cache_key, image_data in rendered:
+                    await self.send_meme_image(bot, to_wxid, cache_key, image_data)
+            logger.info(f"成功发送批量表情: {emoji_type}，共{len(avatars)}人")
             
-            # 1. 优先使用get_contact方法获取头像
+        except Exception as e:
+            await self.report_render_error(bot, to_wxid, emoji_type, e)
+
+    async def report_render_error(self, bot, to_wxid, emoji_type, error):
+        """记录生成表情失败的原因并提示用户"""
+        if isinstance(error, RenderQueueFull):
+            logger.warning(f"渲染队列已满，丢弃表情请求: {emoji_type}, {str(error)}")
+            await bot.send_text_message(to_wxid, "表情生成繁忙，请稍后再试")
+        elif isinstance(error, asyncio.TimeoutError):
+            logger.error(f"生成表情超时: {emoji_type}")
+            await bot.send_text_message(to_wxid, "生成表情超时，请稍后再试")
+        else:
+            logger.error(f"生成表情失败: {str(error)}")
+            await bot.send_text_message(to_wxid, f"生成表情失败: {str(error)}")
+
+    async def render_for_avatars(self, to_wxid, emoji_type, avatars):
+        """读取头像并生成表情，优先复用已渲染结果，返回(缓存键, 图片字节)"""
+        args = {"circle": True}
+        image_hashes = [await self.avatar_content_hash(avatar) for avatar in avatars]
+        
+        # 相同表情、相同头像内容、预处理尺寸、参数和优化选项直接复用已渲染结果，
+        # 命中时不需要解码头像
+        self.template_usage[emoji_type] += 1
+        optimize = self.get_optimize_options(emoji_type)
+        cache_key = RenderCache.make_key(
+            emoji_type, image_hashes, {"args": args, "optimize": optimize, "avatar_size": self.avatar_size}
+        )
+        image_data = self.render_cache.get(cache_key) if self.render_cache is not None else None
+        if image_data is not None:
+            logger.info(f"命中表情缓存: {emoji_type}")
+            self.metrics.inc("cache", cache="render", result="hit")
+        else:
+            self.metrics.inc("cache", cache="render", result="miss")
+            images = [(await self.load_avatar_image(avatar))[1] for avatar in avatars]
+            # 交给调度器排队渲染，相同的渲染请求同时到达时只渲染一次
+            image_data = await self.scheduler.submit(
+                to_wxid, cache_key, self.render_meme, cache_key, emoji_type, images, args, optimize
+            )
+        return cache_key, image_data
+
+    async def compose_batch(self, to_wxid, emoji_type, rendered):
+        """把同一表情的多张结果拼成网格图，返回(缓存键, 图片字节)"""
+        optimize = self.get_optimize_options(emoji_type)
+        cache_key = RenderCache.make_key(
+            "grid", [key for key, _ in rendered],
+            {"columns": self.batch_columns, "cell_size": self.batch_cell_size, "optimize": optimize},
+        )
+        image_data = self.render_cache.get(cache_key) if self.render_cache is not None else None
+        if image_data is not None:
+            self.metrics.inc("cache", cache="render", result="hit")
+            return cache_key, image_data
+        
+        self.metrics.inc("cache", cache="render", result="miss")
+        image_data = await self.scheduler.submit(
+            to_wxid, cache_key, self.compose_meme, cache_key, emoji_type,
+            [data for _, data in rendered], optimize,
+        )
+        return cache_key, image_data
+
+    def get_optimize_options(self, emoji_type):
+        """合并全局和指定表情类型的输出优化配置，未启用时返回None"""
+        config = self.optimize_config
+        if not config.get("enable", False):
+            return None
+        
+        options = {
+            "dedupe_frames": config.get("dedupe_frames", True),
+            "max_fps": config.get("max_fps", 0),
+            "max_side": config.get("max_side", 0),
+            "colors": config.get("colors", 256),
+            "max_kb": config.get("max_kb", 0),
+            "static": emoji_type in config.get("static_templates", []),
+        }
+        options.update(config.get("templates", {}).get(emoji_type, {}))
+        options["max_bytes"] = int(options.pop("max_kb") * 1024)
+        return options
+    
+    async def paced_send(self, send_func, *args):
+        """按[send] interval配置的最小间隔依次发送"""
+        async with self.send_lock:
+            wait = self.last_send_time + self.send_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                return await send_func(*args)
+            finally:
+                self.last_send_time = time.monotonic()
+    
+    async def send_meme_image(self, bot, to_wxid, cache_key, image_data):
+        """发送表情图片，热门表情通过文件助手缓存的图片消息转发，避免重复上传"""
+        media_xml = self.media_handles.get(cache_key)
+        if media_xml:
+            self.media_handles.move_to_end(cache_key)
             try:
-                profile = await bot.get_contact(wxid)
-                if profile and isinstance(profile, dict):
-                    logger.info(f"获取到用户资料: {profile}")
-                    if "BigHeadImgUrl" in profile and profile["BigHeadImgUrl"]:
-                        avatar_url = profile["BigHeadImgUrl"]
-                        avatar_source = "联系人信息"
-                    elif "SmallHeadImgUrl" in profile and profile["SmallHeadImgUrl"]:
-                        avatar_url = profile["SmallHeadImgUrl"]
-                        avatar_source = "联系人信息"
+                await self.paced_send(bot.send_cdn_img_msg, to_wxid, media_xml)
+                self.metrics.inc("cache", cache="media", result="hit")
+                return
             except Exception as e:
-                logger.warning(f"通过get_contact获取头像失败: {str(e)}")
-            
-            # 2. 如果是群聊消息，尝试从群获取用户头像
-            if not avatar_url and from_wxid and "@chatroom" in from_wxid:
-                try:
-                    # 获取群成员列表
-                    group_members = await bot.get_chatroom_member_list(from_wxid)
-                    logger.info(f"获取到群成员列表，共{len(group_members) if isinstance(group_members, list) else 0}个成员")
-                    
-                    if isinstance(group_members, list) and group_members:
-                        # 查找目标用户
-                        for member in group_members:
-                            if isinstance(member, dict) and "UserName" in member and member["UserName"] == wxid:
-                                logger.info(f"在群成员中找到目标用户: {member}")
-                                # 提取头像URL
-                                if "BigHeadImgUrl" in member and member["BigHeadImgUrl"]:
-                                    avatar_url = member["BigHeadImgUrl"]
-                                    avatar_source = "群成员列表"
-                                    break
-                                elif "SmallHeadImgUrl" in member and member["SmallHeadImgUrl"]:
-                                    avatar_url = member["SmallHeadImgUrl"]
-                                    avatar_source = "群成员列表"
-                                    break
-                
-                except Exception as e:
-                    logger.warning(f"从群成员列表获取头像失败: {str(e)}")
+                # 转发失败（如CDN资源已过期）时丢弃缓存，改为重新上传
+                logger.warning(f"转发缓存表情失败，重新上传: {str(e)}")
+                self.media_handles.pop(cache_key, None)
+        
+        await self.paced_send(bot.send_image_message, to_wxid, image_data)
+        
+        if not self.use_filehelper_cache:
+            return
+        self.metrics.inc("cache", cache="media", result="miss")
+        
+        # 同一表情请求次数达到阈值后，在后台上传到文件助手以便之后直接转发
+        hits = self.render_hits.pop(cache_key, 0) + 1
+        self.render_hits[cache_key] = hits
+        while len(self.render_hits) > self.media_cache_size * 4:
+            self.render_hits.popitem(last=False)
+        if hits >= self.filehelper_min_hits and cache_key not in self.upload_flight \
+                and cache_key not in self.upload_failures:
+            self.create_background_task(
+                self.upload_flight.do(cache_key, self.upload_to_filehelper, bot, cache_key, image_data)
+            )
+    
+    async def upload_to_filehelper(self, bot, cache_key, image_data):
+        """把表情发到文件助手，等待回显的图片消息并记住其XML
+        
+        回显只按消息ID或图片MD5匹配，避免把文件助手里的其他图片当成表情转发。
+        等不到回显的表情在filehelper_retry_after秒内不再上传，连续超时
+        filehelper_max_timeouts次后关闭文件助手缓存。
+        """
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        digest = hashlib.md5(image_data).hexdigest()
+        self.pending_upload_digests[digest] = waiter
+        try:
+            result = await self.paced_send(bot.send_image_message, self.filehelper_wxid, image_data)
+            new_msg_id = result[2] if isinstance(result, (tuple, list)) and len(result) >= 3 else None
+            if new_msg_id and not waiter.done():
+                self.pending_uploads[str(new_msg_id)] = waiter
             
-            # 3. 如果前两种方式都失败，尝试通过个人资料API获取
-            if not avatar_url:
-                try:
-                    user_info = await bot.get_profile(wxid)
-                    if user_info and isinstance(user_info, dict):
-                        logger.info(f"获取到用户资料(get_profile): {user_info}")
-                        # 尝试各种可能的头像字段名
-                        for field in ["smallHeadImgUrl", "avatar", "avatarUrl", "headImgUrl"]:
-                            if field in user_info and user_info[field]:
-                                avatar_url = user_info[field]
-                                avatar_source = "个人资料"
-                                break
-                
-                except Exception as e:
-                    logger.warning(f"通过个人资料获取头像失败: {str(e)}")
+            media_xml = await asyncio.wait_for(waiter, self.gif_cache_wait)
+        except asyncio.TimeoutError:
+            logger.debug(f"等待文件助手回显超时，不缓存该表情: {cache_key}")
+            self.upload_failures.add(cache_key)
+            self.filehelper_timeouts += 1
+            if self.filehelper_max_timeouts and self.filehelper_timeouts >= self.filehelper_max_timeouts \
+                    and self.use_filehelper_cache:
+                self.use_filehelper_cache = False
+                logger.warning(f"连续 {self.filehelper_timeouts} 次收不到文件助手回显，已关闭文件助手缓存")
+            return
+        except Exception as e:
+            logger.warning(f"上传表情到文件助手失败: {str(e)}")
+            self.upload_failures.add(cache_key)
+            return
+        finally:
+            for pending in (self.pending_uploads, self.pending_upload_digests):
+                for key in [key for key, future in pending.items() if future is waiter]:
+                    del pending[key]
+        
+        self.filehelper_timeouts = 0
+        self.media_handles[cache_key] = media_xml
+        while len(self.media_handles) > self.media_cache_size:
+            self.media_handles.popitem(last=False)
+        logger.info(f"表情已缓存到文件助手: {cache_key}")
+    
+    @on_image_message()
+    async def handle_image(self, bot: WechatAPIClient, message: dict):
+        """捕获发往文件助手的图片消息回显，用于表情转发缓存"""
+        if not self.enable or not (self.pending_uploads or self.pending_upload_digests):
+            return
+        if self.filehelper_wxid not in (message.get("FromWxid"), message.get("ToWxid")):
+            return
+        
+        media_xml = message.get("Content")
+        if not isinstance(media_xml, str) or "<img" not in media_xml:
+            return
+        
+        # 按消息ID匹配，发送接口没返回消息ID时按XML中的图片MD5匹配；
+        # 都匹配不上的是用户自己发到文件助手的图片，不能当成表情缓存
+        msg_id = str(message.get("NewMsgId") or message.get("MsgId") or "")
+        waiter = self.pending_uploads.pop(msg_id, None)
+        if waiter is None:
+            match = re.search(r'\bmd5\s*=\s*"([0-9a-fA-F]{32})"', media_xml)
+            waiter = self.pending_upload_digests.pop(match.group(1).lower(), None) if match else None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(media_xml)
+
+    async def avatar_content_hash(self, avatar_path):
+        """返回头像文件的原始内容哈希，不解码图片
+        
+        按内容存储的头像文件名就是内容哈希；其他文件优先取预处理缓存中的哈希，否则读取文件计算。
+        """
+        if os.path.dirname(os.path.dirname(avatar_path)) == self.blob_dir:
+            return os.path.splitext(os.path.basename(avatar_path))[0]
+        entry = self.avatar_images.get(AvatarImageCache.file_key(avatar_path))
+        if entry is not None:
+            return entry[0]
+        
+        def file_hash():
+            with open(avatar_path, "rb") as f:
+                return hashlib.sha1(f.read()).hexdigest()
+        return await asyncio.to_thread(file_hash)
+    
+    async def load_avatar_image(self, avatar_path):
+        """读取预处理后的头像，返回(原始内容哈希, 图片字节)
+        
+        同一头像文件只解码、裁剪、缩放一次，之后直接从内存缓存读取。
+        """
+        key = AvatarImageCache.file_key(avatar_path)
+        entry = self.avatar_images.get(key)
+        if entry is not None:
+            self.metrics.inc("cache", cache="avatar_image", result="hit")
+            return entry
+        
+        self.metrics.inc("cache", cache="avatar_image", result="miss")
+        with open(avatar_path, "rb") as f:
+            raw_data = f.read()
+        # 按内容存储的头像文件名就是内容哈希，无需重新计算
+        if os.path.dirname(os.path.dirname(avatar_path)) == self.blob_dir:
+            content_hash = os.path.splitext(os.path.basename(avatar_path))[0]
+        else:
+            content_hash = hashlib.sha1(raw_data).hexdigest()
+        try:
+            with self.metrics.span("normalize"):
+                data = await asyncio.to_thread(normalize_avatar, raw_data, self.avatar_size)
+        except Exception as e:
+            # 无法解码时交给meme_generator自行处理原始图片
+            logger.warning(f"预处理头像失败，使用原始图片: {avatar_path}, {str(e)}")
+            data = raw_data
+        self.avatar_images.put(key, content_hash, data)
+        return content_hash, data
+
+    async def render_meme(self, cache_key, emoji_type, images, args, optimize=None):
+        """在渲染进程池中生成表情（不阻塞事件循环）并写入结果缓存"""
+        async with self.render_section(cache_key):
+            image_data = self.get_shared_render(cache_key)
+            if image_data is not None:
+                return image_data
+            with self.metrics.span("render", emoji_type):
+                image_data = await self.renderer.render(emoji_type, images, [], args, optimize)
+            if self.render_cache is not None:
+                self.render_cache.put(cache_key, image_data)
+        return image_data
+
+    async def compose_meme(self, cache_key, emoji_type, images, optimize=None):
+        """在渲染进程池中拼接网格图并写入结果缓存"""
+        async with self.render_section(cache_key):
+            image_data = self.get_shared_render(cache_key)
+            if image_data is not None:
+                return image_data
+            with self.metrics.span("compose", emoji_type):
+                image_data = await self.renderer.compose(images, self.batch_columns, self.batch_cell_size, optimize)
+            if self.render_cache is not None:
+                self.render_cache.put(cache_key, image_data)
+        return image_data
+
+    def shared_section(self, key, blocking=True):
+        """多个实例之间的互斥区，返回的上下文值表示是否拿到了锁；未启用共享缓存时不加锁"""
+        if self.shared_lock is None:
+            return contextlib.nullcontext(True)
+        return self.shared_lock.locked(key, self.shared_lock_timeout, blocking)
+
+    def render_section(self, cache_key):
+        """同一渲染结果的跨实例互斥区
+        
+        只有结果缓存带磁盘层时其他实例才能读到发布的结果，否则加锁只会让它们白等，直接不加锁。
+        """
+        if self.render_cache is None or not self.render_cache.disk_dir:
+            return contextlib.nullcontext(True)
+        return self.shared_section(f"render:{cache_key}")
+    
+    def get_shared_render(self, cache_key):
+        """读取其他实例在等待锁期间发布的渲染结果，没有时返回None"""
+        if self.shared_lock is None or self.render_cache is None or not self.render_cache.disk_dir:
+            return None
+        image_data = self.render_cache.get(cache_key)
+        if image_data is not None:
+            self.metrics.inc("cache", cache="shared_render", result="hit")
+        return image_data
+
+    async def download_avatar(self, bot, wxid, from_wxid=None, force_update=False):
+        """获取用户头像路径，优先使用未过期的本地缓存"""
+        entry = self.avatar_index.get(wxid)
+        avatar_path = self.avatar_blob_path(entry)
+        
+        if not force_update and avatar_path:
+            self.increase_avatar_count(wxid)
+            if self.is_avatar_fresh(wxid, entry):
+                logger.debug(f"使用缓存头像: {avatar_path}")
+                self.metrics.inc("cache", cache="avatar", result="hit")
+                return avatar_path
             
-            # 如果获取不到头像URL，返回None
-            if not avatar_url:
-                logger.error(f"无法获取用户 {wxid} 的头像")
-                return None
+            # 缓存已过期：先返回旧头像，后台刷新
+            logger.debug(f"头像缓存已过期，后台刷新: {wxid}")
+            self.metrics.inc("cache", cache="avatar", result="stale")
+            self.schedule_avatar_refresh(bot, wxid, from_wxid)
+            return avatar_path
+        
+        self.metrics.inc("cache", cache="avatar", result="miss")
+        result = await self.avatar_flight.do(wxid, self.fetch_avatar, bot, wxid, from_wxid)
+        if result:
+            self.increase_avatar_count(wxid)
+        elif avatar_path:
+            # 刷新失败时继续使用旧头像
+            logger.warning(f"头像刷新失败，继续使用旧缓存: {wxid}")
+            return avatar_path
+        return result
+    
+    def schedule_avatar_refresh(self, bot, wxid, from_wxid=None):
+        """在后台刷新过期头像，同一用户同时只刷新一次"""
+        if wxid in self.avatar_flight:
+            return
+        
+        self.create_background_task(self.avatar_flight.do(wxid, self.fetch_avatar, bot, wxid, from_wxid))
+    
+    def is_avatar_fresh(self, wxid, entry=None):
+        """根据头像标记和最后更新时间判断缓存是否仍然有效"""
+        if entry is None:
+            entry = self.avatar_index.get(wxid)
+        if not entry:
+            return False
+        
+        ttl = self.real_avatar_ttl if entry["mark"] == "real" else self.default_avatar_ttl
+        return time.time() - entry["updated_at"] < ttl
+    
+    def blob_path(self, content_hash):
+        """按内容哈希返回头像文件路径，按哈希前两位分目录"""
+        return os.path.join(self.blob_dir, content_hash[:2], f"{content_hash}.jpg")
+    
+    def avatar_blob_path(self, entry):
+        """返回索引记录对应的头像文件路径，文件不存在时返回None"""
+        if not entry or not entry.get("content_hash"):
+            return None
+        path = self.blob_path(entry["content_hash"])
+        return path if os.path.exists(path) else None
+    
+    def migrate_legacy_avatars(self):
+        """把旧版本按wxid存储的头像文件迁移为按内容哈希存储，返回迁移的文件数"""
+        migrated = 0
+        with os.scandir(self.avatar_dir) as entries:
+            legacy = [entry for entry in entries if entry.name.endswith(".jpg") and entry.is_file()]
+        for entry in legacy:
+            wxid = entry.name[:-len(".jpg")]
+            try:
+                with open(entry.path, "rb") as f:
+                    data = f.read()
+                content_hash = hashlib.sha1(data).hexdigest()
+                path = self.blob_path(content_hash)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if os.path.exists(path):
+                    os.remove(entry.path)
+                else:
+                    os.replace(entry.path, path)
+                self.avatar_index.set_content(wxid, content_hash, len(data))
+                migrated += 1
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"迁移旧版头像文件失败: {entry.path}, {str(e)}")
+        return migrated
+    
+    def increase_avatar_count(self, wxid):
+        """头像使用次数加一"""
+        try:
+            self.avatar_index.touch(wxid)
+        except sqlite3.Error as e:
+            logger.warning(f"更新头像使用计数失败: {str(e)}")
+    
+    async def fetch_avatar(self, bot, wxid, from_wxid=None):
+        """从微信接口解析头像地址并下载到缓存目录，近期失败过的用户直接跳过"""
+        if wxid in self.negative_cache:
+            logger.debug(f"用户头像近期获取失败，跳过: {wxid}")
+            self.metrics.inc("cache", cache="avatar_negative", result="hit")
+            return None
+        
+        async with self.shared_section(f"avatar:{wxid}"):
+            # 等待锁期间其他实例可能已经下载了这个头像
+            if self.shared_lock:
+                entry = self.avatar_index.get(wxid)
+                avatar_path = self.avatar_blob_path(entry)
+                if avatar_path and self.is_avatar_fresh(wxid, entry):
+                    self.metrics.inc("cache", cache="shared_avatar", result="hit")
+                    return avatar_path
             
-            # 下载头像
-            logger.info(f"下载头像: {avatar_url} (来源: {avatar_source})")
             try:
-                async with aiohttp.ClientSession() as session:
-                    # 添加超时设置
-                    timeout = aiohttp.ClientTimeout(total=10)
-                    headers = {
-                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-                    }
+                avatar_url, avatar_source, avatar_mark = await self.resolve_avatar_url(bot, wxid, from_wxid)
+                
+                # 如果获取不到头像URL，返回None
+                if not avatar_url:
+                    logger.error(f"无法获取用户 {wxid} 的头像")
+                    self.negative_cache.add(wxid)
+                    return None
+                
+                avatar_path = await self.save_avatar(wxid, avatar_url, avatar_mark, avatar_source)
+                if not avatar_path:
+                    self.negative_cache.add(wxid)
+                return avatar_path
                     
-                    async with session.get(avatar_url, headers=headers, timeout=timeout) as resp:
-                        if resp.status == 200:
-                            # 直接保存到头像文件
-                            with open(avatar_path, "wb") as f:
-                                avatar_data = await resp.read()
-                                f.write(avatar_data)
-                            
-                            # 检查下载的文件是否有效
-                            if os.path.exists(avatar_path) and os.path.getsize(avatar_path) > 100:
-                                logger.info(f"头像下载成功: {avatar_path}")
-                                return avatar_path
-                            else:
-                                logger.error(f"下载的头像文件无效")
-                                return None
-                        else:
-                            logger.error(f"下载头像失败，状态码: {resp.status}")
-                            return None
             except Exception as e:
-                logger.error(f"下载头像异常: {str(e)}")
+                logger.error(f"获取头像过程中发生错误: {str(e)}")
                 return None
-                
+    
+    async def call_avatar_source(self, source, wxid, func, *args):
+        """经熔断器和负缓存调用头像接口，跳过或失败时返回None
+        
+        接口抛出异常计为一次失败；该接口对此用户失败过时，负缓存期内不再调用。
+        """
+        if (source, wxid) in self.negative_cache:
+            self.metrics.inc("avatar_source", source=source, result="negative")
+            return None
+        breaker = self.breakers[source]
+        if not breaker.allow():
+            self.metrics.inc("avatar_source", source=source, result="open")
+            return None
+        
+        try:
+            with self.metrics.span(source):
+                result = await func(*args)
+        except Exception:
+            breaker.record_failure()
+            self.negative_cache.add((source, wxid))
+            self.metrics.inc("avatar_source", source=source, result="error")
+            if breaker.state == CircuitBreaker.OPEN:
+                logger.warning(f"头像接口 {source} 连续失败，熔断{self.breaker_cooldown}秒")
+            raise
+        breaker.record_success()
+        return result
+    
+    async def resolve_avatar_url(self, bot, wxid, from_wxid=None):
+        """依次通过联系人信息、群成员索引和个人资料解析头像地址，返回(url, 来源, 标记)"""
+        avatar_url = None
+        avatar_source = "未知"
+        # 只有高清头像视为真实头像（real），其余视为默认头像（default），过期更快
+        avatar_mark = "default"
+        
+        # 1. 优先使用get_contact方法获取头像
+        try:
+            profile = await self.call_avatar_source("get_contact", wxid, bot.get_contact, wxid)
+            if profile and isinstance(profile, dict):
+                logger.info(f"获取到用户资料: {profile}")
+                if "BigHeadImgUrl" in profile and profile["BigHeadImgUrl"]:
+                    avatar_url = profile["BigHeadImgUrl"]
+                    avatar_source = "联系人信息"
+                    avatar_mark = "real"
+                elif "SmallHeadImgUrl" in profile and profile["SmallHeadImgUrl"]:
+                    avatar_url = profile["SmallHeadImgUrl"]
+                    avatar_source = "联系人信息"
+        except Exception as e:
+            logger.warning(f"通过get_contact获取头像失败: {str(e)}")
+        
+        # 2. 如果是群聊消息，尝试从群成员索引获取用户头像
+        if not avatar_url and from_wxid and "@chatroom" in from_wxid:
+            try:
+                member = await self.call_avatar_source(
+                    "chatroom_member", wxid, self.get_member_avatar, bot, from_wxid, wxid
+                )
+                if member:
+                    avatar_url, avatar_mark = member
+                    avatar_source = "群成员列表"
+            except Exception as e:
+                logger.warning(f"从群成员列表获取头像失败: {str(e)}")
+        
+        # 3. 如果前两种方式都失败，尝试通过个人资料API获取
+        if not avatar_url:
+            try:
+                user_info = await self.call_avatar_source("get_profile", wxid, bot.get_profile, wxid)
+                if user_info and isinstance(user_info, dict):
+                    logger.info(f"获取到用户资料(get_profile): {user_info}")
+                    # 尝试各种可能的头像字段名
+                    for field in ["smallHeadImgUrl", "avatar", "avatarUrl", "headImgUrl"]:
+                        if field in user_info and user_info[field]:
+                            avatar_url = user_info[field]
+                            avatar_source = "个人资料"
+                            break
+            
+            except Exception as e:
+                logger.warning(f"通过个人资料获取头像失败: {str(e)}")
+        
+        return avatar_url, avatar_source, avatar_mark
+    
+    async def save_avatar(self, wxid, avatar_url, avatar_mark, avatar_source="未知"):
+        """下载头像并按内容哈希保存，成功返回头像路径
+        
+        地址未变化时跳过下载；否则带上ETag/Last-Modified发起条件请求，
+        内容未变化（304）时只刷新更新时间。内容相同的头像只保存一份。
+        """
+        entry = self.avatar_index.get(wxid)
+        old_path = self.avatar_blob_path(entry)
+        same_url = old_path is not None and entry.get("url") == avatar_url
+        
+        if same_url and self.skip_unchanged_url:
+            logger.debug(f"头像地址未变化，跳过下载: {wxid}")
+            self.metrics.inc("avatar_refresh", result="unchanged_url")
+            self.avatar_index.record_refresh(wxid, avatar_mark)
+            return old_path
+        
+        headers = {}
+        if same_url:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        
+        # 近期下载失败的地址和熔断中的CDN直接跳过
+        if ("download", avatar_url) in self.negative_cache:
+            self.metrics.inc("avatar_source", source="download", result="negative")
+            return None
+        breaker = self.breakers["download"]
+        if not breaker.allow():
+            self.metrics.inc("avatar_source", source="download", result="open")
+            return None
+        
+        logger.info(f"下载头像: {avatar_url} (来源: {avatar_source})")
+        try:
+            session = self.get_http_session()
+            with self.metrics.span("download"):
+                async with session.get(avatar_url, headers=headers) as resp:
+                    if resp.status == 304 and old_path:
+                        breaker.record_success()
+                        logger.debug(f"头像未变化: {wxid}")
+                        self.metrics.inc("avatar_refresh", result="not_modified")
+                        self.avatar_index.record_refresh(wxid, avatar_mark)
+                        return old_path
+                    if resp.status != 200:
+                        logger.error(f"下载头像失败，状态码: {resp.status}")
+                        # 服务端错误计入熔断，其余状态码只负缓存该地址
+                        if resp.status >= 500:
+                            breaker.record_failure()
+                        else:
+                            breaker.record_success()
+                        self.negative_cache.add(("download", avatar_url))
+                        return None
+                    avatar_data = await resp.read()
+                    etag = resp.headers.get("ETag")
+                    last_modified = resp.headers.get("Last-Modified")
+            breaker.record_success()
+            
+            # 检查下载的文件是否有效
+            if len(avatar_data) <= 100:
+                logger.error(f"下载的头像文件无效")
+                return None
+            
+            # 相同内容的头像已存在时直接复用，否则原子写入
+            content_hash = hashlib.sha1(avatar_data).hexdigest()
+            avatar_path = self.blob_path(content_hash)
+            if os.path.exists(avatar_path):
+                self.metrics.inc("avatar_refresh", result="dedup")
+            else:
+                os.makedirs(os.path.dirname(avatar_path), exist_ok=True)
+                atomic_write(avatar_path, avatar_data)
+                self.metrics.inc("avatar_refresh", result="downloaded")
+                self.schedule_quota_check()
+            logger.info(f"头像下载成功: {avatar_path}")
+            
+            self.avatar_index.record_download(
+                wxid, avatar_mark, avatar_source, content_hash, len(avatar_data),
+                avatar_url, etag, last_modified,
+            )
+            # 旧头像不再被任何用户引用时删除
+            if entry and entry.get("content_hash") and entry["content_hash"] != content_hash:
+                self.remove_unreferenced_blobs([entry["content_hash"]])
+            return avatar_path
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"下载头像异常: {str(e)}")
+            breaker.record_failure()
+            self.negative_cache.add(("download", avatar_url))
+            return None
         except Exception as e:
-            logger.error(f"获取头像过程中发生错误: {str(e)}")
+            logger.error(f"下载头像异常: {str(e)}")
+            return None
+    
+    async def get_member_avatar(self, bot, chatroom, wxid):
+        """从群成员头像索引中查找用户头像，返回(url, 标记)，找不到返回None
+        
+        索引过期时整体刷新；用户不在索引中时（如新成员入群），距上次刷新超过
+        member_refresh_interval 才会重新拉取，避免频繁请求完整成员列表。
+        """
+        index = self.chatroom_members.get(chatroom)
+        now = time.time()
+        if (index is None or now - index["updated"] > self.member_index_ttl or
+                (wxid not in index["members"] and now - index["updated"] > self.member_refresh_interval)):
+            await self.member_flight.do(chatroom, self.refresh_member_index, bot, chatroom)
+            index = self.chatroom_members.get(chatroom)
+        
+        if not index:
             return None
+        return index["members"].get(wxid)
+    
+    async def refresh_member_index(self, bot, chatroom):
+        """拉取一次完整群成员列表并更新该群的头像索引"""
+        group_members = await bot.get_chatroom_member_list(chatroom)
+        
+        members = {}
+        if isinstance(group_members, list):
+            for member in group_members:
+                if not isinstance(member, dict) or not member.get("UserName"):
+                    continue
+                if member.get("BigHeadImgUrl"):
+                    members[member["UserName"]] = (member["BigHeadImgUrl"], "real")
+                elif member.get("SmallHeadImgUrl"):
+                    members[member["UserName"]] = (member["SmallHeadImgUrl"], "default")
+        
+        # 只有新增或头像地址变化的成员需要后续处理
+        old_index = self.chatroom_members.get(chatroom)
+        old_members = old_index["members"] if old_index else {}
+        changed = [wxid for wxid, entry in members.items() if old_members.get(wxid) != entry]
+        self.chatroom_members[chatroom] = {"updated": time.time(), "members": members}
+        logger.info(f"群成员头像索引已更新: {chatroom}，共{len(members)}个成员，变化{len(changed)}个")
+        
+        # 群首次使用插件时，在后台预热全部成员头像
+        if old_index is None and self.member_warm_avatars and changed:
+            self.create_background_task(self.warm_member_avatars(chatroom, changed))
+    
+    async def warm_member_avatars(self, chatroom, wxids):
+        """在后台预先下载群成员头像"""
+        semaphore = asyncio.Semaphore(self.member_warm_concurrency)
+        members = self.chatroom_members.get(chatroom, {}).get("members", {})
+        
+        async def warm(wxid):
+            async with semaphore:
+                entry = members.get(wxid)
+                if not entry or self.is_avatar_fresh(wxid):
+                    return
+                avatar_url, avatar_mark = entry
+                await self.avatar_flight.do(wxid, self.save_avatar, wxid, avatar_url, avatar_mark, "群成员列表")
+        
+        await asyncio.gather(*(warm(wxid) for wxid in wxids))
+        logger.info(f"群成员头像预热完成: {chatroom}，共{len(wxids)}个成员")
+    
+    def create_background_task(self, coro):
+        """创建后台任务并保留引用，防止任务被提前回收"""
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
 
     async def send_emoji_list(self, bot, to_wxid):
-        """发送表情列表"""
-        single_emoji_list = list(self.single_emojis.keys())
-        two_person_emoji_list = list(self.two_person_emojis.keys())
+        """发送表情列表：优先发送缓存的预览图，预览图未生成或已过期时发送文字列表"""
+        if self.preview_enable:
+            pages = await asyncio.to_thread(self.gallery.current_pages)
+            if pages:
+                for path in pages:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                    # 预览图文件名包含emoji.json的哈希，可直接作为媒体缓存键
+                    await self.send_meme_image(bot, to_wxid, f"preview:{os.path.basename(path)}", data)
+                return
+            if self.preview_auto_build:
+                self.schedule_gallery_build()
+        
+        single_emoji_list = list(self.config.single_emojis.keys())
+        two_person_emoji_list = list(self.config.two_person_emojis.keys())
         
         response = "【单人表情】"
         response += "、".join(single_emoji_list) if single_emoji_list else "没有单人表情触发词"
@@ -367,6 +1273,32 @@ class MemeGen(PluginBase):
         
         await bot.send_text_message(to_wxid, response)
 
+    def schedule_gallery_build(self):
+        """在后台生成表情预览图，同时只运行一个生成任务"""
+        if self.gallery_task is None or self.gallery_task.done():
+            self.gallery_task = self.create_background_task(self.build_gallery())
+    
+    async def build_gallery(self):
+        """预览图过期时用示例头像重新渲染全部表情并生成预览图"""
+        async with self.shared_section("preview", blocking=False) as acquired:
+            # 共享缓存时由一个实例生成即可
+            if not acquired:
+                return
+            
+            async def render(emoji_type, images):
+                return await self.renderer.render(emoji_type, images, [], {"circle": True})
+            
+            start = time.perf_counter()
+            try:
+                # 与用户请求共用渲染引擎，只占用一个渲染名额
+                pages, results = await self.gallery.build(render, concurrency=1)
+            except Exception as e:
+                logger.error(f"生成表情预览图失败: {str(e)}")
+                return
+            if results is not None:
+                failed = [result["emoji_type"] for result in results if result["error"]]
+                logger.info(f"表情预览图已生成，共{len(pages)}页，耗时{time.perf_counter() - start:.1f}秒，失败{len(failed)}个: {failed}")
+
     async def handle_enable_disable_commands(self, bot, message):
         """处理表情的启用/禁用命令"""
         content = message.get("Content", "").strip()
@@ -375,53 +1307,74 @@ class MemeGen(PluginBase):
         actual_user_id = message.get("ActualUserWxid", "")
         
         # 检查权限
-        admin_users = self.get_admin_users()
-        if actual_user_id not in admin_users:
+        config = self.config
+        if actual_user_id not in config.admin_users:
             await bot.send_text_message(from_wxid, "只有管理员才有权执行此操作！")
             return
             
         # 解析命令
-        match = re.match(r'^(全局)?(禁用|启用)表情\s+(.+)$', content)
+        match = TOGGLE_COMMAND_PATTERN.match(content)
         if not match:
             return
             
         is_global, action, emoji_name = match.groups()
         
         # 检查表情是否存在
-        emoji_type = self.single_emojis.get(emoji_name)
-        if not emoji_type and emoji_name not in self.two_person_emojis:
+        emoji_type = config.single_emojis.get(emoji_name)
+        if not emoji_type and emoji_name not in config.two_person_emojis:
             await bot.send_text_message(from_wxid, "未找到指定的表情！")
             return
             
         group_id = from_wxid if is_group else None
         
+        # 配置快照只读，修改禁用状态时基于最新快照生成新快照再替换
         if is_global:  # 全局控制
+            config = self.config
             if action == "禁用":
-                self.globally_disabled_emojis.add(emoji_name)
+                self.config = config._replace(globally_disabled=config.globally_disabled | {emoji_name})
                 await bot.send_text_message(from_wxid, f"已全局禁用表情：{emoji_name}")
             else:  # 启用
-                self.globally_disabled_emojis.discard(emoji_name)
+                self.config = config._replace(globally_disabled=config.globally_disabled - {emoji_name})
                 await bot.send_text_message(from_wxid, f"已全局启用表情：{emoji_name}")
         else:  # 群组控制
             if group_id:
+                config = self.config
+                group_disabled = dict(config.group_disabled)
                 if action == "禁用":
-                    if group_id not in self.disabled_emojis:
-                        self.disabled_emojis[group_id] = set()
-                    self.disabled_emojis[group_id].add(emoji_name)
+                    group_disabled[group_id] = group_disabled.get(group_id, frozenset()) | {emoji_name}
+                    self.config = config._replace(group_disabled=MappingProxyType(group_disabled))
                     await bot.send_text_message(from_wxid, f"已在当前群禁用表情：{emoji_name}")
                 else:  # 启用
-                    if group_id in self.disabled_emojis:
-                        self.disabled_emojis[group_id].discard(emoji_name)
+                    if group_id in group_disabled:
+                        group_disabled[group_id] = group_disabled[group_id] - {emoji_name}
+                        self.config = config._replace(group_disabled=MappingProxyType(group_disabled))
                         await bot.send_text_message(from_wxid, f"已在当前群启用表情：{emoji_name}")
             else:
                 await bot.send_text_message(from_wxid, "该命令只能在群聊中使用")
     
+    def may_handle(self, message):
+        """判断消息是否可能是本插件的命令或表情请求"""
+        content = message.get("Content")
+        if not content:
+            return False
+        
+        # 命令消息
+        content = content.strip()
+        config = self.config
+        if content.startswith(COMMAND_PREFIXES) or content in config.list_command_set:
+            return True
+        
+        # 表情请求必须@了用户，且包含至少一个触发词的首字符
+        if not (message.get("AtUserList") or message.get("Ats")):
+            return False
+        return not config.trigger_chars.isdisjoint(content)
+    
     def extract_at_users(self, content, message):
         """从消息内容中提取被@的用户wxid"""
         at_users = []
         
         # 输出原始消息内容中的AtUserList字段
-        logger.info(f"原始消息AtUserList: {message.get('AtUserList', 'None')}, Ats: {message.get('Ats', 'None')}")
+        logger.debug(f"原始消息AtUserList: {message.get('AtUserList', 'None')}, Ats: {message.get('Ats', 'None')}")
         
         # 从消息对象中提取被@用户
         if "AtUserList" in message and isinstance(message["AtUserList"], list):
@@ -439,42 +1392,121 @@ class MemeGen(PluginBase):
     
     def clean_at_text(self, content):
         """移除所有@部分并返回清理后的字符串"""
-        # 修改正则表达式，避免过度清理
-        clean_content = re.sub(r'@[\u4e00-\u9fa5a-zA-Z0-9_\^\-~\*]+(?:\s*[\u4e00-\u9fa5a-zA-Z0-9_\^\-~\*]+)*\s*', '', content)
+        # 只移除以\u2005结尾的@昵称，避免把触发词当作昵称的一部分清理掉
+        clean_content = AT_MENTION_PATTERN.sub('', content)
         result = clean_content.strip()
         logger.debug(f"原内容: '{content}', 清理后: '{result}'")
         return result
     
     def get_admin_users(self):
-        """获取管理员用户列表"""
-        try:
-            # 首先尝试从全局配置文件获取管理员列表
-            global_admins = []
-            config_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "config.json")
-            if os.path.exists(config_path):
-                try:
-                    with open(config_path, 'r', encoding='utf-8') as f:
-                        config = json.load(f)
-                        
-                    # 尝试获取管理员列表
-                    if "admin_users" in config:
-                        global_admins.extend(config["admin_users"])
-                    if "admins" in config:
-                        global_admins.extend(config["admins"])
-                except Exception as e:
-                    logger.warning(f"读取全局管理员配置失败: {str(e)}")
-            
-            # 合并全局管理员和本地管理员
-            all_admins = set(global_admins + self.local_admin_users)
-            return list(all_admins)
-        except Exception as e:
-            logger.error(f"获取管理员列表失败: {str(e)}")
-            # 发生错误时返回本地管理员列表作为后备
-            return self.local_admin_users
+        """获取管理员用户集合（全局配置和本插件配置中的管理员）"""
+        return self.config.admin_users
         
     async def async_init(self):
         """异步初始化函数"""
-        pass
+        if not self.enable:
+            return
+        
+        # 启动渲染进程池和调度器，并在后台预热最常用的表情
+        warmup = [emoji_type for emoji_type, _ in self.template_usage.most_common(self.warmup_templates)]
+        self.renderer.start(warmup)
+        self.scheduler.start()
+        if warmup:
+            self.create_background_task(self.warm_up_renderer(warmup))
+        
+        # 创建共享的HTTP会话
+        self.get_http_session()
+        
+        # 启动时检查一次头像磁盘配额
+        self.schedule_quota_check()
+        
+        # 预览图过期时在后台重新生成
+        if self.preview_enable and self.preview_auto_build:
+            self.schedule_gallery_build()
+    
+    async def warm_up_renderer(self, warmup):
+        """后台拉起渲染进程并预热常用表情"""
+        start = time.perf_counter()
+        try:
+            await self.renderer.warm_up()
+            logger.info(f"渲染进程预热完成，共{len(warmup)}个表情，耗时{time.perf_counter() - start:.1f}秒")
+        except Exception as e:
+            logger.warning(f"渲染进程预热失败: {str(e)}")
+    
+    def load_template_usage(self):
+        """读取持久化的表情使用次数"""
+        try:
+            with open(self.template_usage_path, "r", encoding="utf-8") as f:
+                return Counter(json.load(f))
+        except FileNotFoundError:
+            return Counter()
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f"读取表情使用次数失败: {str(e)}")
+            return Counter()
+    
+    def save_template_usage(self):
+        """持久化表情使用次数"""
+        try:
+            data = json.dumps(dict(self.template_usage), ensure_ascii=False)
+            atomic_write(self.template_usage_path, data.encode("utf-8"))
+        except OSError as e:
+            logger.warning(f"保存表情使用次数失败: {str(e)}")
+    
+    async def on_disable(self):
+        """插件禁用时释放资源"""
+        await super().on_disable()
+        if self.enable:
+            self.save_template_usage()
+        # 先停掉后台任务（预览图生成、头像刷新、配额检查等），
+        # 否则它们会在关闭后重新拉起渲染进程池或HTTP会话
+        tasks = list(self.background_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for flight in (self.upload_flight, self.avatar_flight, self.member_flight):
+            await flight.cancel()
+        if self.scheduler:
+            await self.scheduler.stop()
+        if self.renderer:
+            self.renderer.shutdown()
+        if self.http_session and not self.http_session.closed:
+            await self.http_session.close()
+            self.http_session = None
+        if self.avatar_index is not None:
+            self.avatar_index.close()
+    
+    def get_http_session(self):
+        """获取共享的HTTP会话，连接池复用keep-alive连接"""
+        if self.http_session is None or self.http_session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.http_limit,
+                limit_per_host=self.http_limit_per_host,
+                ttl_dns_cache=300,
+                keepalive_timeout=self.http_keepalive,
+            )
+            self.http_session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.http_timeout),
+                headers={
+                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+                },
+            )
+        return self.http_session
+
+    def dump_metrics_file(self):
+        """把性能指标以Prometheus文本格式写入temp/metrics.prom"""
+        try:
+            atomic_write(os.path.join(self.temp_dir, "metrics.prom"), self.metrics.prometheus().encode("utf-8"))
+        except OSError as e:
+            logger.warning(f"写入性能指标文件失败: {str(e)}")
+    
+    @schedule('interval', minutes=1)
+    async def dump_metrics(self, bot: WechatAPIClient):
+        """定期导出性能指标并保存表情使用次数"""
+        if not self.enable:
+            return
+        self.dump_metrics_file()
+        self.save_template_usage()
 
     @schedule('interval', hours=24)
     async def cleanup_avatar_cache(self, bot: WechatAPIClient):
@@ -484,113 +1516,141 @@ class MemeGen(PluginBase):
             
         logger.info("开始清理头像缓存...")
         try:
-            current_time = time.time()
-            avatars_cleaned = 0
-            total_files = 0
-            
-            # 获取所有缓存文件
-            for filename in os.listdir(self.avatar_dir):
-                total_files += 1
-                filepath = os.path.join(self.avatar_dir, filename)
-                
-                # 跳过目录
-                if os.path.isdir(filepath):
-                    continue
-                    
-                # 检查是否是头像文件
-                if filename.endswith('.jpg'):
-                    wxid = filename[:-4]  # 移除.jpg后缀
-                    
-                    # 检查使用计数和最后更新时间
-                    use_count_file = os.path.join(self.avatar_dir, f"{wxid}.count")
-                    last_update_file = os.path.join(self.avatar_dir, f"{wxid}.update")
-                    
-                    should_remove = False
-                    
-                    # 如果存在使用计数文件，检查使用次数
-                    if os.path.exists(use_count_file):
-                        try:
-                            with open(use_count_file, 'r') as f:
-                                count = int(f.read().strip())
-                                
-                            # 如果使用次数少于配置的阈值，并且超过配置的天数未更新，删除文件
-                            if count < self.cleanup_threshold and os.path.exists(last_update_file):
-                                try:
-                                    with open(last_update_file, 'r') as f:
-                                        last_update = float(f.read().strip())
-                                        
-                                    if current_time - last_update > self.cleanup_expire_days * 86400:
-                                        should_remove = True
-                                except:
-                                    pass
-                        except:
-                            pass
-                    
-                    # 执行清理
-                    if should_remove:
-                        try:
-                            # 删除所有相关文件
-                            for ext in ['.jpg', '.mark', '.update', '.count', '.tmp']:
-                                ext_file = os.path.join(self.avatar_dir, f"{wxid}{ext}")
-                                if os.path.exists(ext_file):
-                                    os.remove(ext_file)
-                                    avatars_cleaned += 1
-                        except Exception as e:
-                            logger.error(f"清理头像文件失败: {str(e)}")
-            
-            logger.info(f"头像缓存清理完成。共清理 {avatars_cleaned} 个文件，剩余 {total_files - avatars_cleaned} 个文件。")
+            # 使用次数少于阈值且超过配置天数未更新的头像
+            expired = await asyncio.to_thread(
+                self.avatar_index.find_expired,
+                self.cleanup_threshold, time.time() - self.cleanup_expire_days * 86400,
+            )
+            avatars_cleaned = await self.remove_avatars_in_batches(expired)
+            logger.info(f"头像缓存清理完成。共清理 {avatars_cleaned} 个头像。")
+            
+            # 清理过期的表情磁盘缓存
+            if self.render_cache is not None:
+                renders_cleaned = await asyncio.to_thread(self.render_cache.cleanup_disk)
+                logger.info(f"表情磁盘缓存清理完成，共清理 {renders_cleaned} 个文件")
         
         except Exception as e:
             logger.error(f"清理头像缓存过程中发生错误: {str(e)}")
+    
+    @schedule('interval', seconds=10)
+    async def reload_config(self, bot: WechatAPIClient):
+        """定期检查配置文件，有变化时重新加载配置快照"""
+        if not self.enable:
+            return
+        await self.reload_config_snapshot()
+    
+    @schedule('interval', minutes=10)
+    async def check_avatar_quota(self, bot: WechatAPIClient):
+        """定期检查头像磁盘配额"""
+        if not self.enable:
+            return
+        self.schedule_quota_check()
+    
+    def schedule_quota_check(self):
+        """在后台检查头像磁盘配额，同时只运行一个检查"""
+        if self.quota_task is None or self.quota_task.done():
+            self.quota_task = self.create_background_task(self.enforce_avatar_quota())
+    
+    async def enforce_avatar_quota(self):
+        """头像文件总大小或数量超出配额时，按LRU/LFU顺序分批淘汰，返回删除的文件数
+        
+        每批只删除少量头像并在工作线程中执行，批次之间让出事件循环；
+        5分钟内使用过的头像不会被淘汰。
+        """
+        max_bytes = int(self.avatar_max_mb * 1024 * 1024)
+        files_removed = 0
+        try:
+            async with self.shared_section("avatar_quota", blocking=False) as acquired:
+                # 共享缓存时同一时间只由一个实例淘汰
+                if acquired:
+                    files_removed = await self.evict_avatars_over_quota(max_bytes)
+        except Exception as e:
+            logger.error(f"检查头像磁盘配额失败: {str(e)}")
+        
+        if files_removed:
+            logger.info(f"头像缓存超出配额，已淘汰 {files_removed} 个头像文件")
+        return files_removed
+    
+    async def evict_avatars_over_quota(self, max_bytes):
+        """分批淘汰头像直到不超出配额，返回删除的文件数"""
+        files_removed = 0
+        while True:
+            files, total_bytes = await asyncio.to_thread(self.avatar_index.disk_usage)
+            if files <= self.avatar_max_files and total_bytes <= max_bytes:
+                break
             
-    async def clear_avatar_cache(self, wxid):
-        """清理特定用户的头像缓存"""
+            candidates = await asyncio.to_thread(
+                self.avatar_index.eviction_candidates,
+                self.eviction_batch_size, self.eviction_policy, time.time() - 300,
+            )
+            if not candidates:
+                logger.warning(f"头像缓存超出配额但没有可淘汰的头像: {files}个文件，{total_bytes / 1048576:.1f}MB")
+                break
+            files_removed += await asyncio.to_thread(self.remove_avatars, candidates)
+            self.metrics.inc("avatar_evicted", len(candidates))
+            await asyncio.sleep(EVICTION_BATCH_PAUSE)
+        return files_removed
+    
+    async def remove_avatars_in_batches(self, wxids):
+        """在工作线程中分批删除头像，批次之间让出事件循环，返回删除的文件数"""
+        files_removed = 0
+        batch_size = max(1, self.eviction_batch_size)
+        for start in range(0, len(wxids), batch_size):
+            files_removed += await asyncio.to_thread(self.remove_avatars, wxids[start:start + batch_size])
+            await asyncio.sleep(EVICTION_BATCH_PAUSE)
+        return files_removed
+    
+    def remove_avatars(self, wxids):
+        """删除头像的索引记录和不再被引用的头像文件，返回删除的文件数"""
+        hashes = set()
+        for wxid in wxids:
+            entry = self.avatar_index.get(wxid)
+            if entry and entry.get("content_hash"):
+                hashes.add(entry["content_hash"])
+        self.avatar_index.delete(wxids)
+        return self.remove_unreferenced_blobs(hashes)
+    
+    def remove_unreferenced_blobs(self, hashes):
+        """删除没有任何用户引用的头像文件，返回删除的文件数"""
         files_removed = 0
-        for ext in ['.jpg', '.mark', '.update', '.count', '.tmp']:
-            ext_file = os.path.join(self.avatar_dir, f"{wxid}{ext}")
-            if os.path.exists(ext_file):
-                os.remove(ext_file)
+        for content_hash in hashes:
+            if self.avatar_index.count_hash(content_hash):
+                continue
+            try:
+                os.remove(self.blob_path(content_hash))
                 files_removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"清理头像文件失败: {str(e)}")
         return files_removed
+            
+    async def clear_avatar_cache(self, wxid):
+        """清理特定用户的头像缓存"""
+        return await asyncio.to_thread(self.remove_avatars, [wxid])
         
     async def clear_all_avatar_cache(self):
         """清理所有头像缓存"""
         current_time = time.time()
-        avatars_cleaned = 0
         
-        # 获取所有缓存文件
-        for filename in os.listdir(self.avatar_dir):
-            filepath = os.path.join(self.avatar_dir, filename)
-            
-            # 跳过目录
-            if os.path.isdir(filepath):
-                continue
-                
-            # 清理所有临时文件
-            if filename.endswith('.tmp'):
-                os.remove(filepath)
-                avatars_cleaned += 1
-                continue
-                
-            # 检查是否是头像文件
-            if filename.endswith('.jpg'):
-                wxid = filename[:-4]  # 移除.jpg后缀
-                
-                # 检查是否超过3天未使用
-                last_update_file = os.path.join(self.avatar_dir, f"{wxid}.update")
-                if os.path.exists(last_update_file):
-                    try:
-                        with open(last_update_file, 'r') as f:
-                            last_update = float(f.read().strip())
-                            
-                        # 如果超过3天未使用，删除文件
-                        if current_time - last_update > 3 * 86400:  # 3天
-                            for ext in ['.jpg', '.mark', '.update', '.count']:
-                                ext_file = os.path.join(self.avatar_dir, f"{wxid}{ext}")
-                                if os.path.exists(ext_file):
-                                    os.remove(ext_file)
-                                    avatars_cleaned += 1
-                    except:
-                        pass
-        
-        return avatars_cleaned 
\ No newline at end of file
+        # 超过3天未更新的头像
+        expired = await asyncio.to_thread(self.avatar_index.find_expired, float("inf"), current_time - 3 * 86400)
+        avatars_cleaned = await self.remove_avatars_in_batches(expired)
+        
+        # 清理残留的临时文件
+        avatars_cleaned += await asyncio.to_thread(self.remove_stale_temp_files, current_time)
+        return avatars_cleaned
+    
+    def remove_stale_temp_files(self, current_time):
+        """删除头像目录中残留的临时文件（跳过1分钟内创建的，可能正在写入），返回删除的文件数"""
+        files_removed = 0
+        for root, _, filenames in os.walk(self.avatar_dir):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                try:
+                    if filename.endswith('.tmp') and current_time - os.path.getmtime(path) > 60:
+                        os.remove(path)
+                        files_removed += 1
+                except OSError:
+                    pass
+        return files_removed
@@ -0,0 +1,68 @@
+"""MemeGen触发词匹配 - 基于Aho-Corasick自动机的多模式匹配"""
+from collections import deque
+
+
+class TriggerMatcher:
+    """触发词匹配器
+
+    在加载表情配置时一次性构建自动机，之后每条消息只需扫描一遍文本即可
+    找出最长的触发词，耗时与触发词数量无关。
+    """
+
+    def __init__(self, triggers):
+        self.triggers = dict(triggers)
+        self._goto = [{}]
+        self._fail = [0]
+        # 每个状态上能匹配到的最长触发词（包含沿失败链可达的触发词）
+        self._output = [None]
+
+        for word in self.triggers:
+            if word:
+                self._insert(word)
+        self._build_fail_links()
+
+    def _insert(self, word):
+        state = 0
+        for char in word:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(None)
+            state = next_state
+        self._output[state] = word
+
+    def _build_fail_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                # 自身路径上的触发词总是最长的，没有时沿用失败状态的结果
+                if self._output[next_state] is None:
+                    self._output[next_state] = self._output[self._fail[next_state]]
+
+    def find_longest(self, text):
+        """返回文本中最长的触发词及其表情类型，未匹配返回None"""
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        best = None
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            word = output[state]
+            if word is not None and (best is None or len(word) > len(best)):
+                best = word
+        if best is None:
+            return None
+        return best, self.triggers[best]
+
+    def __len__(self):
+        return len(self.triggers)
@@ -0,0 +1,131 @@
+"""MemeGen性能指标 - 各阶段耗时、缓存命中率和渲染队列状态"""
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class Histogram:
+    """保留最近若干次采样的耗时分布"""
+
+    def __init__(self, window=1024):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q):
+        """返回最近采样窗口内的分位数（q取0~1）"""
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+        return ordered[index]
+
+
+class MemeMetrics:
+    """表情生成流水线的指标收集器
+
+    耗时按(阶段, 表情类型)分组，计数器和仪表盘按名称和标签分组；
+    可输出为管理员查看的文本摘要或Prometheus文本格式。
+    """
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, window=1024):
+        self.window = window
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, stage, seconds, template=None):
+        """记录一次阶段耗时（秒）"""
+        key = (stage, template or "")
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.window)
+        histogram.observe(seconds)
+
+    @contextmanager
+    def span(self, stage, template=None):
+        """统计代码块的耗时，异常退出时同样记录"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, template)
+
+    def inc(self, name, value=1, **labels):
+        """计数器加value"""
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, func):
+        """注册仪表盘，func在输出时调用以获取当前值"""
+        self.gauges[name] = func
+
+    def cache_ratio(self, cache):
+        """返回指定缓存的(命中数, 未命中数)"""
+        hits = self.counters.get(("cache", (("cache", cache), ("result", "hit"))), 0)
+        misses = self.counters.get(("cache", (("cache", cache), ("result", "miss"))), 0)
+        return hits, misses
+
+    def summary(self):
+        """生成供管理员查看的文本摘要"""
+        lines = ["【阶段耗时 p50/p95/p99（毫秒）】"]
+        for (stage, template), histogram in sorted(self.histograms.items()):
+            p50, p95, p99 = (histogram.percentile(q) * 1000 for q in self.QUANTILES)
+            name = f"{stage}/{template}" if template else stage
+            lines.append(f"{name}: {p50:.0f}/{p95:.0f}/{p99:.0f}（{histogram.count}次）")
+
+        caches = sorted({dict(labels).get("cache") for name, labels in self.counters if name == "cache"})
+        if caches:
+            lines.append("\n【缓存命中率】")
+            for cache in caches:
+                hits, misses = self.cache_ratio(cache)
+                total = hits + misses
+                ratio = hits / total * 100 if total else 0
+                lines.append(f"{cache}: {ratio:.1f}%（命中{hits}/共{total}）")
+
+        if self.gauges:
+            lines.append("\n【当前状态】")
+            for name, func in sorted(self.gauges.items()):
+                lines.append(f"{name}: {func()}")
+
+        return "\n".join(lines)
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ""
+        pairs = ",".join(f'{key}="{value}"' for key, value in labels)
+        return "{" + pairs + "}"
+
+    def prometheus(self):
+        """生成Prometheus文本格式的指标"""
+        lines = ["# TYPE memegen_stage_seconds summary"]
+        for (stage, template), histogram in sorted(self.histograms.items()):
+            labels = [("stage", stage)]
+            if template:
+                labels.append(("template", template))
+            for q in self.QUANTILES:
+                quantile_labels = self._format_labels(labels + [("quantile", str(q))])
+                lines.append(f"memegen_stage_seconds{quantile_labels} {histogram.percentile(q):.6f}")
+            lines.append(f"memegen_stage_seconds_count{self._format_labels(labels)} {histogram.count}")
+            lines.append(f"memegen_stage_seconds_sum{self._format_labels(labels)} {histogram.sum:.6f}")
+
+        counter_names = sorted({name for name, _ in self.counters})
+        for name in counter_names:
+            lines.append(f"# TYPE memegen_{name}_total counter")
+            for (counter_name, labels), value in sorted(self.counters.items()):
+                if counter_name == name:
+                    lines.append(f"memegen_{name}_total{self._format_labels(labels)} {value}")
+
+        for name, func in sorted(self.gauges.items()):
+            lines.append(f"# TYPE memegen_{name} gauge")
+            lines.append(f"memegen_{name} {func()}")
+
+        return "\n".join(lines) + "\n"
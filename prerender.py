@@ -0,0 +1,341 @@
+"""MemeGen批量预渲染和表情预览图
+
+用示例头像把 emoji.json 中的全部表情并行渲染一遍，报告每个表情的渲染耗时和输出大小，
+并生成带触发词标注的预览图（可分页）。预览图缓存在 temp/preview 下，
+只有 emoji.json、meme_generator 版本或排版参数变化时才重新生成。
+
+在机器人根目录下运行：
+    python -m plugins.MemeGen.prerender --workers 4
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import math
+import os
+import time
+import tomllib
+
+from loguru import logger
+from PIL import Image, ImageDraw, ImageFont
+
+from .cache import atomic_write
+from .render import MemeRenderer, RenderQueueFull
+
+# 常见系统中带中文字形的字体，未配置字体时依次尝试
+FONT_CANDIDATES = (
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/google-noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/usr/share/fonts/wenquanyi/wqy-microhei/wqy-microhei.ttc",
+    "/System/Library/Fonts/PingFang.ttc",
+    "C:/Windows/Fonts/msyh.ttc",
+)
+
+# 渲染队列已满时的最大重试次数（与机器人共用渲染引擎时可能发生）
+MAX_RETRIES = 30
+
+
+def meme_generator_version():
+    """返回已安装的meme_generator版本，未安装时返回"unknown\""""
+    from importlib.metadata import PackageNotFoundError, version
+    for name in ("meme_generator", "meme-generator"):
+        try:
+            return version(name)
+        except PackageNotFoundError:
+            continue
+    return "unknown"
+
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def load_templates(emoji_path):
+    """读取emoji.json，返回[(表情类型, 人数, [触发词...])]，同一表情的多个触发词合并"""
+    with open(emoji_path, "r", encoding="utf-8") as f:
+        emoji_config = json.load(f)
+
+    templates = {}
+    for section, persons in (("one_PicEwo", 1), ("two_PicEwo", 2)):
+        for trigger, emoji_type in emoji_config.get(section, {}).items():
+            templates.setdefault((emoji_type, persons), []).append(trigger)
+    return [(emoji_type, persons, triggers) for (emoji_type, persons), triggers in templates.items()]
+
+
+def make_sample_avatar(color=(255, 170, 90), size=256):
+    """生成示例头像：纯色背景上的简单笑脸"""
+    image = Image.new("RGB", (size, size), color)
+    draw = ImageDraw.Draw(image)
+    eye = size // 10
+    draw.ellipse((size * 0.3 - eye, size * 0.38 - eye, size * 0.3 + eye, size * 0.38 + eye), fill=(40, 40, 40))
+    draw.ellipse((size * 0.7 - eye, size * 0.38 - eye, size * 0.7 + eye, size * 0.38 + eye), fill=(40, 40, 40))
+    draw.arc((size * 0.25, size * 0.4, size * 0.75, size * 0.8), 20, 160, fill=(40, 40, 40), width=max(2, size // 40))
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+
+def load_font(font_path, size):
+    """加载标注触发词用的字体，找不到中文字体时退回PIL默认字体"""
+    for path in ((font_path,) if font_path else ()) + FONT_CANDIDATES:
+        if path and os.path.exists(path):
+            try:
+                return ImageFont.truetype(path, size)
+            except OSError:
+                continue
+    logger.warning("未找到中文字体，预览图中的触发词可能无法正常显示，可在[preview] font中指定字体文件")
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:  # Pillow 10.1之前的默认字体不支持指定大小
+        return ImageFont.load_default()
+
+
+async def prerender_all(render, templates, avatars, concurrency=2):
+    """并行渲染全部表情
+
+    render 为 async (emoji_type, images) -> bytes，avatars 为两张示例头像；
+    返回与 templates 顺序一致的结果字典列表。
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def one(emoji_type, persons, triggers):
+        result = {"emoji_type": emoji_type, "persons": persons, "triggers": triggers,
+                  "seconds": 0.0, "size": 0, "data": None, "error": None}
+        async with semaphore:
+            for _ in range(MAX_RETRIES):
+                start = time.perf_counter()
+                try:
+                    data = await render(emoji_type, avatars[:persons])
+                except RenderQueueFull:
+                    await asyncio.sleep(1)
+                    continue
+                except Exception as e:
+                    result["error"] = str(e) or type(e).__name__
+                else:
+                    result.update(seconds=time.perf_counter() - start, size=len(data), data=data)
+                break
+            else:
+                result["error"] = "渲染队列持续繁忙"
+        return result
+
+    return await asyncio.gather(*(one(*template) for template in templates))
+
+
+def first_frame(data, size):
+    """取图片第一帧并缩放到size以内"""
+    image = Image.open(io.BytesIO(data))
+    image.seek(0)
+    frame = image.convert("RGBA")
+    frame.thumbnail((size, size), Image.LANCZOS)
+    return frame
+
+
+def build_contact_sheet(results, columns=6, cell_size=200, per_page=36, font_path=""):
+    """把渲染结果排成带触发词标注的预览图，返回各页JPEG字节"""
+    columns = max(1, columns)
+    per_page = max(columns, per_page)
+    caption_height = max(16, cell_size // 7)
+    font = load_font(font_path, caption_height - 4)
+    pages = []
+
+    for page_start in range(0, len(results), per_page):
+        page_results = results[page_start:page_start + per_page]
+        rows = math.ceil(len(page_results) / columns)
+        sheet = Image.new("RGB", (columns * cell_size, rows * (cell_size + caption_height)), (255, 255, 255))
+        draw = ImageDraw.Draw(sheet)
+
+        for index, result in enumerate(page_results):
+            left = index % columns * cell_size
+            top = index // columns * (cell_size + caption_height)
+            image_size = cell_size - 8
+            if result["data"]:
+                try:
+                    frame = first_frame(result["data"], image_size)
+                    sheet.paste(frame, (left + (cell_size - frame.width) // 2, top + (image_size - frame.height) // 2 + 4), frame)
+                except Exception as e:
+                    logger.warning(f"读取预渲染结果失败: {result['emoji_type']}, {str(e)}")
+            else:
+                draw.rectangle((left + 4, top + 4, left + cell_size - 4, top + image_size + 4), outline=(200, 200, 200))
+
+            caption = "/".join(result["triggers"])
+            if result["persons"] == 2:
+                caption += "（双人）"
+            while len(caption) > 1 and draw.textlength(caption, font=font) > cell_size - 4:
+                caption = caption[:-2] + "…"
+            width = draw.textlength(caption, font=font)
+            draw.text((left + (cell_size - width) / 2, top + cell_size), caption, fill=(30, 30, 30), font=font)
+
+        output = io.BytesIO()
+        sheet.save(output, format="JPEG", quality=85, optimize=True)
+        pages.append(output.getvalue())
+
+    return pages
+
+
+class PreviewGallery:
+    """缓存在磁盘上的表情预览图
+
+    manifest.json 记录生成时的 emoji.json 哈希、meme_generator 版本和排版参数，
+    任何一项变化时预览图视为过期。
+    """
+
+    def __init__(self, preview_dir, emoji_path, options=None):
+        self.preview_dir = preview_dir
+        self.emoji_path = emoji_path
+        self.options = options or {}
+        self.manifest_path = os.path.join(preview_dir, "manifest.json")
+
+    def fingerprint(self):
+        return {
+            "emoji": file_digest(self.emoji_path),
+            "meme_generator": meme_generator_version(),
+            "options": self.options,
+        }
+
+    def read_manifest(self):
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def current_pages(self):
+        """预览图未过期时返回各页文件路径，否则返回None"""
+        manifest = self.read_manifest()
+        if not manifest or manifest.get("fingerprint") != self.fingerprint():
+            return None
+        pages = [os.path.join(self.preview_dir, name) for name in manifest.get("pages", [])]
+        if not pages or not all(os.path.exists(path) for path in pages):
+            return None
+        return pages
+
+    def save(self, pages, fingerprint):
+        """写入各页预览图和清单，返回各页文件路径"""
+        os.makedirs(self.preview_dir, exist_ok=True)
+        digest = fingerprint["emoji"][:8]
+        names = [f"preview_{digest}_{index + 1}.jpg" for index in range(len(pages))]
+        for name, data in zip(names, pages):
+            atomic_write(os.path.join(self.preview_dir, name), data)
+        manifest = {"fingerprint": fingerprint, "pages": names, "created": time.time()}
+        atomic_write(self.manifest_path, json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8"))
+
+        # 删除旧版本的预览图
+        for filename in os.listdir(self.preview_dir):
+            if filename.startswith("preview_") and filename not in names:
+                try:
+                    os.remove(os.path.join(self.preview_dir, filename))
+                except OSError:
+                    pass
+        return [os.path.join(self.preview_dir, name) for name in names]
+
+    async def build(self, render, avatars=None, concurrency=2, force=False):
+        """预览图过期（或force为True）时重新渲染并生成，返回(各页路径, 渲染结果)
+
+        预览图未过期时渲染结果为None。
+        """
+        if not force:
+            pages = await asyncio.to_thread(self.current_pages)
+            if pages:
+                return pages, None
+
+        fingerprint = await asyncio.to_thread(self.fingerprint)
+        templates = await asyncio.to_thread(load_templates, self.emoji_path)
+        if avatars is None:
+            avatars = [make_sample_avatar(), make_sample_avatar((120, 180, 255))]
+        results = await prerender_all(render, templates, avatars, concurrency)
+        pages = await asyncio.to_thread(
+            build_contact_sheet, results,
+            self.options.get("columns", 6), self.options.get("cell_size", 200),
+            self.options.get("per_page", 36), self.options.get("font", ""),
+        )
+        paths = await asyncio.to_thread(self.save, pages, fingerprint)
+        return paths, results
+
+
+def print_report(results):
+    """打印各表情的渲染耗时和输出大小"""
+    print(f"{'表情类型':<24}{'人数':>4}{'耗时':>12}{'大小':>12}  触发词")
+    for result in sorted(results, key=lambda r: r["seconds"], reverse=True):
+        status = f"  失败: {result['error']}" if result["error"] else ""
+        print(f"{result['emoji_type']:<24}{result['persons']:>4}{result['seconds'] * 1000:>9.1f} ms"
+              f"{result['size'] / 1024:>9.1f} KB  {'/'.join(result['triggers'])}{status}")
+
+    succeeded = [result for result in results if not result["error"]]
+    total_seconds = sum(result["seconds"] for result in succeeded)
+    total_size = sum(result["size"] for result in succeeded)
+    print(f"\n成功 {len(succeeded)}/{len(results)}，渲染总耗时 {total_seconds:.1f} 秒，输出总大小 {total_size / 1048576:.1f} MB")
+
+
+def load_plugin_config(plugin_dir):
+    """读取插件config.toml中的预览图配置和缓存根目录，保证与插件生成的预览图一致"""
+    try:
+        with open(os.path.join(plugin_dir, "config.toml"), "rb") as f:
+            config = tomllib.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"读取插件配置失败，使用默认参数: {str(e)}")
+        config = {}
+    cache_dir = config.get("shared", {}).get("dir") or os.environ.get("MEMEGEN_TEMP_DIR") or os.path.join(plugin_dir, "temp")
+    return config.get("preview", {}), cache_dir
+
+
+async def main(options):
+    plugin_dir = os.path.dirname(os.path.abspath(__file__))
+    emoji_path = options.emoji or os.path.join(plugin_dir, "emoji.json")
+    preview_dir = options.output or os.path.join(options.cache_dir, "preview")
+    gallery = PreviewGallery(preview_dir, emoji_path, {
+        "columns": options.columns, "cell_size": options.cell_size,
+        "per_page": options.per_page, "font": options.font,
+    })
+
+    avatars = None
+    if options.avatar:
+        with open(options.avatar, "rb") as f:
+            avatar = f.read()
+        avatars = [avatar, avatar]
+
+    renderer = MemeRenderer(options.workers, queue_size=options.workers, timeout=options.timeout)
+    renderer.start()
+
+    async def render(emoji_type, images):
+        return await renderer.render(emoji_type, images, [], {"circle": True})
+
+    start = time.perf_counter()
+    try:
+        pages, results = await gallery.build(render, avatars, max(1, options.workers), options.force)
+    finally:
+        renderer.shutdown()
+
+    if results is None:
+        print("预览图已是最新，无需重新生成（使用 --force 强制重新生成）")
+    else:
+        print_report(results)
+        print(f"总耗时 {time.perf_counter() - start:.1f} 秒")
+    print("预览图:")
+    for path in pages:
+        print(f"  {path}")
+
+
+def parse_args():
+    # 排版参数默认与插件的[preview]配置一致，生成的预览图可直接被插件使用
+    preview_config, cache_dir = load_plugin_config(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description="MemeGen批量预渲染和表情预览图生成")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="渲染进程数")
+    parser.add_argument("--timeout", type=float, default=60, help="单个表情渲染超时（秒）")
+    parser.add_argument("--avatar", default="", help="示例头像文件，默认使用生成的笑脸头像")
+    parser.add_argument("--emoji", default="", help="表情配置文件，默认使用插件目录下的emoji.json")
+    parser.add_argument("--output", default="", help="预览图输出目录，默认为插件使用的preview目录")
+    parser.add_argument("--columns", type=int, default=preview_config.get("columns", 6), help="预览图列数")
+    parser.add_argument("--cell-size", type=int, default=preview_config.get("cell_size", 200), help="每个表情的格子边长（像素）")
+    parser.add_argument("--per-page", type=int, default=preview_config.get("per_page", 36), help="每页表情数")
+    parser.add_argument("--font", default=preview_config.get("font", ""), help="标注触发词用的字体文件")
+    parser.add_argument("--force", action="store_true", help="即使预览图未过期也重新生成")
+    parser.set_defaults(cache_dir=cache_dir)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,391 @@
+"""MemeGen渲染引擎 - 在独立进程池中执行CPU密集的表情生成，避免阻塞机器人事件循环
+
+本模块不依赖机器人框架，工作进程只需导入这里的函数即可完成渲染。
+"""
+import asyncio
+import io
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from loguru import logger
+from PIL import Image, ImageSequence
+
+# 工作进程内的meme生成器缓存，每个进程各自持有一份
+_meme_cache = {}
+
+# 编码GIF时alpha低于该值的像素视为透明
+ALPHA_THRESHOLD = 128
+
+
+def _get_meme(emoji_type):
+    """获取（并缓存）当前进程中的meme生成器"""
+    if emoji_type not in _meme_cache:
+        from meme_generator import get_meme
+        _meme_cache[emoji_type] = get_meme(emoji_type)
+    return _meme_cache[emoji_type]
+
+
+def render_meme(emoji_type, images, texts=None, args=None, optimize=None):
+    """生成表情并返回图片字节（在工作进程中执行），optimize不为空时顺带做体积优化"""
+    meme_gen = _get_meme(emoji_type)
+    result = meme_gen(images=images, texts=texts or [], args=args or {})
+
+    # 处理协程结果
+    if asyncio.iscoroutine(result):
+        result = asyncio.run(result)
+
+    data = result.getvalue() if isinstance(result, io.BytesIO) else bytes(result)
+    if optimize:
+        data = optimize_image(data, optimize)
+    return data
+
+
+def _sample_avatar():
+    """生成用于预热的示例头像"""
+    output = io.BytesIO()
+    Image.new("RGBA", (256, 256), (200, 200, 200, 255)).save(output, format="PNG")
+    return output.getvalue()
+
+
+def warm_up_worker(emoji_types):
+    """工作进程初始化：预加载常用表情生成器，并用示例头像试渲染一次以加载模板资源"""
+    if not emoji_types:
+        return
+    sample = _sample_avatar()
+    for emoji_type in emoji_types:
+        try:
+            meme_gen = _get_meme(emoji_type)
+            count = max(1, getattr(getattr(meme_gen, "params_type", None), "min_images", 1))
+            render_meme(emoji_type, [sample] * count, [], {"circle": True})
+        except Exception as e:
+            # 预热失败不能影响进程池，真正渲染时会再报错
+            logger.warning(f"预热表情失败: {emoji_type}, {str(e)}")
+
+
+def _fit_size(size, max_side, scale=1.0):
+    """按最大边长和缩放比例计算新尺寸"""
+    width, height = size
+    ratio = scale
+    if max_side and max(width, height) * ratio > max_side:
+        ratio = max_side / max(width, height)
+    if ratio >= 1:
+        return size
+    return max(1, round(width * ratio)), max(1, round(height * ratio))
+
+
+def _encode_static(image, max_side, scale=1.0):
+    frame = image.convert("RGBA")
+    new_size = _fit_size(frame.size, max_side, scale)
+    if new_size != frame.size:
+        frame = frame.resize(new_size, Image.LANCZOS)
+    output = io.BytesIO()
+    frame.save(output, format="PNG", optimize=True)
+    return output.getvalue()
+
+
+def _transparent_mask(frame):
+    """返回frame中按GIF规则应视为透明的像素遮罩，没有透明像素时返回None"""
+    mask = frame.getchannel("A").point(lambda a: 255 if a < ALPHA_THRESHOLD else 0)
+    return mask if mask.getbbox() else None
+
+
+def _encode_gif(frames, durations, loop, max_side, colors, scale=1.0):
+    new_size = _fit_size(frames[0].size, max_side, scale)
+    resized = [frame if frame.size == new_size else frame.resize(new_size, Image.LANCZOS) for frame in frames]
+    masks = [_transparent_mask(frame) for frame in resized]
+
+    # GIF只有1位透明：有透明像素时给透明色预留调色板最后一个索引
+    transparent = any(mask is not None for mask in masks)
+    if transparent:
+        colors = max(2, colors - 1)
+    palette_frames = []
+    for frame, mask in zip(resized, masks):
+        if not transparent:
+            palette_frames.append(frame.quantize(colors=colors, method=Image.Quantize.FASTOCTREE))
+            continue
+        quantized = frame.convert("RGB").quantize(colors=colors, method=Image.Quantize.FASTOCTREE)
+        palette = quantized.getpalette()[:colors * 3]
+        quantized.putpalette(palette + [0] * (colors * 3 - len(palette)) + [0, 0, 0])
+        if mask is not None:
+            quantized.paste(colors, mask=mask)
+        quantized.info["transparency"] = colors
+        palette_frames.append(quantized)
+
+    output = io.BytesIO()
+    save_options = {"transparency": colors} if transparent else {}
+    palette_frames[0].save(
+        output, format="GIF", save_all=True, append_images=palette_frames[1:],
+        duration=durations, loop=loop, optimize=True, disposal=2, **save_options,
+    )
+    return output.getvalue()
+
+
+def optimize_image(data, options):
+    """压缩生成的表情
+
+    options 支持的键：
+    - static：只输出第一帧的静态PNG
+    - dedupe_frames：合并连续的重复帧
+    - max_fps：最大帧率，超出时合并相邻帧
+    - max_side：最大边长（像素）
+    - colors：GIF调色板颜色数
+    - max_bytes：目标体积，超出时逐步缩小尺寸和颜色数
+    结果不比原图小时返回原图。
+    """
+    max_side = options.get("max_side") or 0
+    max_bytes = options.get("max_bytes") or 0
+    colors = max(2, min(256, int(options.get("colors") or 256)))
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        animated = getattr(image, "is_animated", False) and getattr(image, "n_frames", 1) > 1
+
+        if options.get("static") or not animated:
+            if not options.get("static") and (not max_side or max(image.size) <= max_side) and \
+                    (not max_bytes or len(data) <= max_bytes):
+                return data
+            candidate = _encode_static(image, max_side)
+            return candidate if options.get("static") or len(candidate) < len(data) else data
+
+        default_duration = image.info.get("duration", 100)
+        loop = image.info.get("loop", 0)
+        frames, durations = [], []
+        last_bytes = None
+        for frame in ImageSequence.Iterator(image):
+            duration = frame.info.get("duration", default_duration) or default_duration
+            rgba = frame.convert("RGBA")
+            if options.get("dedupe_frames", True):
+                frame_bytes = rgba.tobytes()
+                if frame_bytes == last_bytes:
+                    durations[-1] += duration
+                    continue
+                last_bytes = frame_bytes
+            frames.append(rgba)
+            durations.append(duration)
+
+        # 帧率上限：时长不足的帧与后一帧合并
+        max_fps = options.get("max_fps") or 0
+        if max_fps and len(frames) > 1:
+            min_duration = 1000 / max_fps
+            kept_frames, kept_durations = [frames[0]], [durations[0]]
+            for frame, duration in zip(frames[1:], durations[1:]):
+                if kept_durations[-1] < min_duration:
+                    kept_durations[-1] += duration
+                else:
+                    kept_frames.append(frame)
+                    kept_durations.append(duration)
+            frames, durations = kept_frames, kept_durations
+
+        if len(frames) == 1:
+            candidate = _encode_static(frames[0], max_side)
+        else:
+            candidate = _encode_gif(frames, durations, loop, max_side, colors)
+
+            # 超出目标体积时逐步缩小尺寸和颜色数
+            scale = 1.0
+            attempts = 0
+            while max_bytes and len(candidate) > max_bytes and attempts < 4:
+                attempts += 1
+                scale *= 0.8
+                colors = max(32, colors // 2)
+                candidate = _encode_gif(frames, durations, loop, max_side, colors, scale)
+
+        return candidate if len(candidate) < len(data) else data
+
+    except Exception as e:
+        logger.warning(f"优化表情体积失败，使用原图: {str(e)}")
+        return data
+
+
+def compose_grid(images, columns=0, cell_size=240, optimize=None):
+    """把同一表情的多张结果拼成一张网格图（在工作进程中执行）
+
+    columns 为0时按接近正方形自动排列；每张图缩放到 cell_size 以内居中放入格子。
+    有动图时输出GIF，帧数和每帧时长取帧数最多的那张，帧数较少的图循环播放。
+    """
+    tiles = []
+    for data in images:
+        image = Image.open(io.BytesIO(data))
+        default_duration = image.info.get("duration", 100) or 100
+        frames, durations = [], []
+        for frame in ImageSequence.Iterator(image):
+            durations.append(frame.info.get("duration", default_duration) or default_duration)
+            frame = frame.convert("RGBA")
+            frame.thumbnail((cell_size, cell_size), Image.LANCZOS)
+            frames.append(frame)
+        tiles.append((frames, durations))
+
+    count = len(tiles)
+    columns = min(count, columns or math.ceil(math.sqrt(count)))
+    rows = math.ceil(count / columns)
+    _, durations = max(tiles, key=lambda tile: len(tile[0]))
+
+    canvases = []
+    for index in range(len(durations)):
+        canvas = Image.new("RGBA", (columns * cell_size, rows * cell_size), (255, 255, 255, 255))
+        for position, (frames, _) in enumerate(tiles):
+            frame = frames[index % len(frames)]
+            left = position % columns * cell_size + (cell_size - frame.width) // 2
+            top = position // columns * cell_size + (cell_size - frame.height) // 2
+            canvas.paste(frame, (left, top), frame)
+        canvases.append(canvas)
+
+    if len(canvases) == 1:
+        data = _encode_static(canvases[0], 0)
+    else:
+        data = _encode_gif(canvases, list(durations), 0, 0, 256)
+    if optimize:
+        data = optimize_image(data, optimize)
+    return data
+
+
+def normalize_avatar(data, size=512):
+    """把头像解码为居中裁剪的正方形RGBA图像，边长超过size时缩小，返回PNG字节"""
+    image = Image.open(io.BytesIO(data))
+    image = image.convert("RGBA")
+
+    width, height = image.size
+    side = min(width, height)
+    if width != height:
+        left = (width - side) // 2
+        top = (height - side) // 2
+        image = image.crop((left, top, left + side, top + side))
+    if side > size:
+        image = image.resize((size, size), Image.LANCZOS)
+
+    # 低压缩级别：体积稍大但工作进程解码很快
+    output = io.BytesIO()
+    image.save(output, format="PNG", compress_level=1)
+    return output.getvalue()
+
+
+def _process_context():
+    """工作进程的启动方式
+    
+    不能用fork：fork出的工作进程会继承父进程当时持有的flock文件锁，
+    锁要等工作进程退出才释放，共享缓存的其他实例会一直拿不到锁。
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+class RenderQueueFull(Exception):
+    """渲染队列已满"""
+
+
+class MemeRenderer:
+    """基于进程池的表情渲染器
+
+    workers 为工作进程数（0 表示退化为线程内渲染），queue_size 为工作进程
+    全部繁忙时允许排队等待的任务数，超出后直接拒绝新任务。
+    """
+
+    def __init__(self, workers=2, queue_size=8, timeout=30):
+        self.workers = max(0, int(workers))
+        self.queue_size = max(0, int(queue_size))
+        self.timeout = timeout
+        self._executor = None
+        self._pending = 0
+        self._warmup = ()
+        self._closed = False  # 已被显式关闭，之后的渲染请求不再重新拉起进程池
+
+    @property
+    def capacity(self):
+        """允许同时在途的最大任务数"""
+        return max(1, self.workers) + self.queue_size
+
+    @property
+    def pending(self):
+        """当前在途（运行中+排队中）的任务数"""
+        return self._pending
+
+    def start(self, warmup=None):
+        """启动工作进程池，warmup为每个工作进程启动时预热的表情类型"""
+        if warmup is not None:
+            self._warmup = tuple(warmup)
+        self._closed = False
+        if self._executor is not None:
+            return
+        if self.workers > 0:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=_process_context(),
+                initializer=warm_up_worker, initargs=(self._warmup,),
+            )
+        else:
+            self._executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="MemeGen", initializer=warm_up_worker, initargs=(self._warmup,)
+            )
+        logger.info(f"MemeGen渲染引擎已启动，工作进程: {self.workers}，队列长度: {self.queue_size}")
+
+    def shutdown(self, wait=False):
+        """关闭工作进程池，wait为True时等待工作进程退出；之后需再次调用start()才能渲染"""
+        self._closed = True
+        self._stop_executor(wait)
+
+    def _stop_executor(self, wait=False):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+            logger.info("MemeGen渲染引擎已关闭")
+
+    async def warm_up(self):
+        """立即拉起全部工作进程（进程池默认按需启动），让预热在空闲时完成"""
+        self._ensure_started()
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(
+            loop.run_in_executor(self._executor, os.getpid) for _ in range(max(1, self.workers))
+        ))
+
+    def _ensure_started(self):
+        if self._closed:
+            raise RuntimeError("渲染引擎已关闭")
+        self.start()
+
+    def _release(self, _future=None):
+        self._pending -= 1
+
+    def _release_threadsafe(self, loop, future):
+        # 关闭时不等待工作进程，任务可能在事件循环关闭后才结束，此时无需再释放名额
+        if loop.is_closed():
+            return
+        try:
+            loop.call_soon_threadsafe(self._release, future)
+        except RuntimeError:
+            pass
+
+    async def render(self, emoji_type, images, texts=None, args=None, optimize=None):
+        """提交渲染任务并等待结果，返回图片字节"""
+        return await self._run(render_meme, emoji_type, images, texts, args, optimize)
+
+    async def compose(self, images, columns=0, cell_size=240, optimize=None):
+        """把多张表情拼成网格图，返回图片字节"""
+        return await self._run(compose_grid, images, columns, cell_size, optimize)
+
+    async def _run(self, func, *args):
+        if self._pending >= self.capacity:
+            raise RenderQueueFull(f"渲染队列已满（{self._pending}/{self.capacity}）")
+
+        self._ensure_started()
+        loop = asyncio.get_running_loop()
+        try:
+            future = self._executor.submit(func, *args)
+        except BrokenProcessPool:
+            # 工作进程异常退出后进程池不可再用，重建后重试一次
+            logger.warning("渲染进程池已损坏，正在重建")
+            self._stop_executor()
+            self.start()
+            future = self._executor.submit(func, *args)
+
+        # 以底层任务真正结束为准释放名额，超时取消不会让队列计数失真
+        self._pending += 1
+        future.add_done_callback(lambda f: self._release_threadsafe(loop, f))
+
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except BrokenProcessPool:
+            self._stop_executor()
+            raise
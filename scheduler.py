@@ -0,0 +1,179 @@
+"""MemeGen渲染调度 - 准入控制、按群限流和按群轮询的有界渲染队列"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+from loguru import logger
+
+from .render import RenderQueueFull
+
+
+class TokenBucket:
+    """令牌桶：每秒补充rate个令牌，最多积攒capacity个"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def consume(self, amount=1):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def is_full(self):
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+class _Job:
+    __slots__ = ("key", "func", "args", "future")
+
+    def __init__(self, key, func, args, future):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.future = future
+
+
+class RenderScheduler:
+    """渲染任务调度器
+
+    - 全局最多同时执行 concurrency 个任务
+    - 排队任务按群分组，各群轮流出队，单个群刷屏不会饿死其他群
+    - 与排队中或执行中的任务键相同的请求直接合并，共享同一结果
+    - 排队总数达到 max_queue 时拒绝新任务
+    - allow() 按群和按用户的令牌桶做准入控制
+    """
+
+    # 令牌桶数量超过该值时清理已回满的桶
+    MAX_BUCKETS = 10000
+
+    def __init__(self, concurrency=2, max_queue=32, group_rate=0.5, group_burst=5, user_rate=0.2, user_burst=3):
+        self.concurrency = max(1, int(concurrency))
+        self.max_queue = max(0, int(max_queue))
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self._group_buckets = {}
+        self._user_buckets = {}
+        self._queues = OrderedDict()  # {group_id: deque[_Job]}，顺序即轮询顺序
+        self._jobs = {}  # 排队中和执行中的任务，用于合并重复请求
+        self._queued = 0
+        self._running = 0
+        self._wakeup = None
+        self._workers = []
+
+    @property
+    def queued(self):
+        return self._queued
+
+    @property
+    def running(self):
+        return self._running
+
+    def allow(self, group_id, user_id):
+        """按群和按用户限流，返回是否允许本次请求"""
+        if len(self._group_buckets) + len(self._user_buckets) > self.MAX_BUCKETS:
+            self._prune_buckets()
+
+        group_bucket = self._group_buckets.get(group_id)
+        if group_bucket is None:
+            group_bucket = self._group_buckets[group_id] = TokenBucket(self.group_rate, self.group_burst)
+        user_bucket = self._user_buckets.get(user_id)
+        if user_bucket is None:
+            user_bucket = self._user_buckets[user_id] = TokenBucket(self.user_rate, self.user_burst)
+
+        # 先检查用户再检查群，被用户限流的请求不消耗群令牌
+        return user_bucket.consume() and group_bucket.consume()
+
+    def _prune_buckets(self):
+        for buckets in (self._group_buckets, self._user_buckets):
+            for key in [key for key, bucket in buckets.items() if bucket.is_full()]:
+                del buckets[key]
+
+    def start(self):
+        """启动调度工作协程"""
+        if self._workers:
+            return
+        self._wakeup = asyncio.Event()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        """停止调度，取消排队中的任务"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        for queue in self._queues.values():
+            for job in queue:
+                if not job.future.done():
+                    job.future.cancel()
+        self._queues.clear()
+        self._jobs.clear()
+        self._queued = 0
+
+    async def submit(self, group_id, key, func, *args):
+        """提交任务并等待结果；相同key的在途任务直接共享结果"""
+        job = self._jobs.get(key)
+        if job is not None:
+            logger.debug(f"合并重复的渲染请求: {key}")
+            return await asyncio.shield(job.future)
+
+        if self._queued >= self.max_queue:
+            raise RenderQueueFull(f"渲染排队已满（{self._queued}/{self.max_queue}）")
+
+        self.start()
+        job = _Job(key, func, args, asyncio.get_running_loop().create_future())
+        self._jobs[key] = job
+        queue = self._queues.get(group_id)
+        if queue is None:
+            queue = self._queues[group_id] = deque()
+        queue.append(job)
+        self._queued += 1
+        self._wakeup.set()
+        return await asyncio.shield(job.future)
+
+    def _next_job(self):
+        """轮询各群队列取出下一个任务"""
+        if not self._queues:
+            return None
+        group_id, queue = self._queues.popitem(last=False)
+        job = queue.popleft()
+        if queue:
+            # 还有任务的群排到轮询末尾
+            self._queues[group_id] = queue
+        self._queued -= 1
+        return job
+
+    async def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            self._running += 1
+            try:
+                result = await job.func(*job.args)
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except Exception as e:
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+            finally:
+                self._running -= 1
+                self._jobs.pop(job.key, None)
+                # 没有调用方等待时也要取走异常，避免告警
+                if job.future.done() and not job.future.cancelled():
+                    job.future.exception()
@@ -0,0 +1,94 @@
+"""MemeGen配置快照 - 预先构建的只读配置，文件变化时在后台重建并整体替换"""
+import json
+import os
+import tomllib
+from types import MappingProxyType
+from typing import NamedTuple
+
+from loguru import logger
+
+from .matcher import TriggerMatcher
+
+
+class ConfigSnapshot(NamedTuple):
+    """某一时刻的只读配置
+
+    消息处理只读取当前快照；配置文件变化或表情被启用/禁用时
+    构建新快照并整体替换，处理中的消息始终看到一致的配置。
+    """
+
+    single_emojis: MappingProxyType  # {触发词: 表情类型}
+    two_person_emojis: MappingProxyType
+    single_matcher: TriggerMatcher
+    two_person_matcher: TriggerMatcher
+    list_commands: tuple
+    list_command_set: frozenset
+    trigger_chars: frozenset  # 触发词首字符，用于快速过滤
+    admin_users: frozenset
+    globally_disabled: frozenset = frozenset()  # 全局禁用的触发词
+    group_disabled: MappingProxyType = MappingProxyType({})  # {group_id: frozenset(触发词)}
+    mtimes: tuple = ()  # 构建时各配置文件的修改时间
+
+    def is_disabled(self, trigger_word, group_id=None):
+        """判断触发词是否被全局或在指定群中禁用"""
+        return trigger_word in self.globally_disabled or trigger_word in self.group_disabled.get(group_id, ())
+
+
+def file_mtimes(paths):
+    """返回各文件的(路径, 修改时间)，文件不存在时修改时间为None"""
+    mtimes = []
+    for path in paths:
+        try:
+            mtimes.append((path, os.stat(path).st_mtime_ns))
+        except OSError:
+            mtimes.append((path, None))
+    return tuple(mtimes)
+
+
+def load_global_admins(global_config_path):
+    """读取机器人全局配置中的管理员列表，读取失败时返回空列表"""
+    if not os.path.exists(global_config_path):
+        return []
+    try:
+        with open(global_config_path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+    except Exception as e:
+        logger.warning(f"读取全局管理员配置失败: {str(e)}")
+        return []
+
+    admins = []
+    if "admin_users" in config:
+        admins.extend(config["admin_users"])
+    if "admins" in config:
+        admins.extend(config["admins"])
+    return admins
+
+
+def load_snapshot(emoji_path, config_path, global_config_path):
+    """读取表情配置、插件配置和全局配置，构建新的配置快照"""
+    # 先记录修改时间再读取，读取期间文件又被修改时下次检查会再次加载
+    mtimes = file_mtimes((emoji_path, config_path, global_config_path))
+
+    if not os.path.exists(emoji_path):
+        raise FileNotFoundError(f"表情配置文件不存在: {emoji_path}")
+    with open(emoji_path, "r", encoding="utf-8") as f:
+        emoji_config = json.load(f)
+    with open(config_path, "rb") as f:
+        config = tomllib.load(f)
+
+    single_emojis = dict(emoji_config.get("one_PicEwo", {}))
+    two_person_emojis = dict(emoji_config.get("two_PicEwo", {}))
+    list_commands = tuple(config.get("commands", {}).get("list_commands", ["表情列表"]))
+    local_admins = config.get("admin", {}).get("admin_users", [])
+
+    return ConfigSnapshot(
+        single_emojis=MappingProxyType(single_emojis),
+        two_person_emojis=MappingProxyType(two_person_emojis),
+        single_matcher=TriggerMatcher(single_emojis),
+        two_person_matcher=TriggerMatcher(two_person_emojis),
+        list_commands=list_commands,
+        list_command_set=frozenset(list_commands),
+        trigger_chars=frozenset(word[0] for word in (*single_emojis, *two_person_emojis) if word),
+        admin_users=frozenset(load_global_admins(global_config_path)) | frozenset(local_admins),
+        mtimes=mtimes,
+    )